@@ -0,0 +1,72 @@
+"""Measures the cost of capturing a single query.
+
+Compares the capture of ``SessionProfiler`` into a list with a capture
+into ``queue.Queue``, which has been used by previous versions and
+takes a mutex on every put and get. Both sessions do the same work
+otherwise, context local sessions capture without taking the session
+lock.
+
+Usage::
+
+    python -m benchmarks.bench_capture [queries]
+
+"""
+from queue import Queue
+import sys
+import timeit
+from types import SimpleNamespace
+
+from easy_profile.profiler import _timer, SessionProfiler
+
+
+class _QueueBuffer(Queue):
+    """Queue with the list interface used by the capture."""
+
+    def append(self, query):
+        self.put(query)
+
+    def __iter__(self):
+        while not self.empty():
+            yield self.get()
+
+
+class QueueProfiler(SessionProfiler):
+    """Reference implementation of the queue based capture."""
+
+    def _create_buffer(self):
+        return _QueueBuffer()
+
+
+def measure(profiler, queries):
+    """Returns capture and hand off time per query in seconds."""
+    # Execution contexts are plain objects, attributes of mocks are slow
+    context = SimpleNamespace(
+        _query_start_time=_timer(), _query_before_ns=0, _query_after_ns=0
+    )
+    capture = profiler._after_cursor_execute
+
+    def session():
+        profiler.begin()
+        try:
+            for _ in range(queries):
+                capture(None, None, "SELECT 1", {}, context, False)
+        finally:
+            profiler.commit()
+        assert len(profiler.stats["call_stack"]) == queries
+
+    return min(timeit.repeat(session, number=1, repeat=5)) / queries
+
+
+def main(queries=100000):
+    results = [
+        ("queue.Queue", measure(QueueProfiler(), queries)),
+        ("list", measure(SessionProfiler(), queries)),
+        ("list, local", measure(SessionProfiler(context_local=True),
+                                queries)),
+    ]
+    for name, result in results:
+        print("{0:<12}{1:>8.0f}ns per query".format(name, result * 1e9))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
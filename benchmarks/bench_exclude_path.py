@@ -0,0 +1,64 @@
+"""Measures matching of ``exclude_path`` patterns by the middleware.
+
+Paths are matched against lists of regex patterns of growing size, once
+with the original linear scan over ``re.match`` and once with patterns
+precompiled by the middleware with and without the decisions cache.
+
+Usage::
+
+    python -m benchmarks.bench_exclude_path [paths]
+
+"""
+import re
+import sys
+import time
+
+from easy_profile import EasyProfileMiddleware
+
+
+def legacy_ignore_request(patterns):
+    def ignore_request(path):
+        return any(re.match(pattern, path) for pattern in patterns)
+    return ignore_request
+
+
+def make_patterns(count):
+    return [r"^/excluded/{0}/".format(n) for n in range(count)]
+
+
+def make_paths(count):
+    # A realistic mix with repeated paths, most of them aren't excluded
+    return [
+        "/excluded/{0}/".format(n % 10) if n % 5 == 0
+        else "/api/items/{0}".format(n % 100)
+        for n in range(count)
+    ]
+
+
+def run(ignore_request, paths):
+    start = time.perf_counter()
+    for path in paths:
+        ignore_request(path)
+    return (time.perf_counter() - start) / len(paths)
+
+
+def main(paths=20000):
+    paths = make_paths(paths)
+    print("{0:>8} {1:>12} {2:>12} {3:>12}".format(
+        "patterns", "legacy", "compiled", "cached"
+    ))
+    for count in (1, 10, 50, 200):
+        patterns = make_patterns(count)
+        results = [run(legacy_ignore_request(patterns), paths)]
+        for cache_size in (0, 1024):
+            mw = EasyProfileMiddleware(
+                None, exclude_path=patterns, exclude_cache_size=cache_size
+            )
+            results.append(run(mw._ignore_request, paths))
+        print("{0:>8} {1:>10.2f}us {2:>10.2f}us {3:>10.2f}us".format(
+            count, *(result * 1e6 for result in results)
+        ))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
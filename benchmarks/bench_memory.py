@@ -0,0 +1,77 @@
+"""Measures memory retained per captured query.
+
+Captures equal statements which are distinct string objects, as
+produced by statements that miss the sqlalchemy compiled cache, and
+compares the current record with the previous one, which had no
+``__slots__`` and retained every statement copy.
+
+Usage::
+
+    python -m benchmarks.bench_memory [queries]
+
+"""
+from collections import namedtuple
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+from easy_profile.profiler import _timer, SessionProfiler
+
+_LegacyQuery = namedtuple(
+    "_LegacyQuery", "statement,parameters,start_time,end_time"
+)
+
+
+class LegacyQuery(_LegacyQuery):
+
+    callsite = rowcount = fetch = None
+
+    @property
+    def duration_ns(self):
+        return self.end_time - self.start_time
+
+
+class LegacyProfiler(SessionProfiler):
+    """Reference implementation of the capture without interning."""
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        self._add_query(LegacyQuery(
+            statement, parameters, context._query_start_time, _timer()
+        ))
+
+
+def measure(profiler, queries):
+    """Returns bytes retained per captured query."""
+    # Execution contexts are plain objects, attributes of mocks are slow
+    context = SimpleNamespace(
+        _query_start_time=_timer(), _query_before_ns=0, _query_after_ns=0
+    )
+    statements = [
+        "SELECT id, name FROM users WHERE id = ?" + " " * (n % 2)
+        for n in range(queries)
+    ]
+
+    profiler.begin()
+    tracemalloc.start()
+    for statement in statements:
+        # Copy the statement as an equal but distinct string object
+        statement = "".join(statement)
+        profiler._after_cursor_execute(
+            None, None, statement, (1,), context, False
+        )
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    profiler.commit()
+    return retained / queries
+
+
+def main(queries=100000):
+    before = measure(LegacyProfiler(), queries)
+    after = measure(SessionProfiler(), queries)
+    print("legacy  {0:>6.0f} bytes per query".format(before))
+    print("compact {0:>6.0f} bytes per query".format(after))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
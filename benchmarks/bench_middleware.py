@@ -0,0 +1,68 @@
+"""Measures per-request overhead of ``EasyProfileMiddleware``.
+
+Every request runs a small WSGI application which executes a few
+statements on an in-memory SQLite database. The same application is
+served without middleware, with per-session listeners and with
+persistent listeners, and the average overhead per request is reported.
+
+Usage::
+
+    python -m benchmarks.bench_middleware [requests]
+
+"""
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+from easy_profile import EasyProfileMiddleware
+from easy_profile.reporters import Reporter
+
+
+class NullReporter(Reporter):
+
+    def report(self, path, stats):
+        pass
+
+
+def make_app(engine):
+    def app(environ, start_response):
+        with engine.connect() as conn:
+            for _ in range(3):
+                conn.execute(text("SELECT 1"))
+        return [b"OK"]
+    return app
+
+
+def run(app, requests):
+    environ = {"PATH_INFO": "/bench", "REQUEST_METHOD": "GET"}
+    start = time.perf_counter()
+    for _ in range(requests):
+        app(environ, None)
+    return (time.perf_counter() - start) / requests
+
+
+def main(requests=5000):
+    engine = create_engine("sqlite://")
+    app = make_app(engine)
+    run(app, 100)  # warm up connection pool and statement cache
+
+    baseline = run(app, requests)
+    print("{0:<12} {1:>10.1f} req/s".format("bare", 1 / baseline))
+
+    for persistent in (False, True):
+        mw = EasyProfileMiddleware(
+            app, engine, reporter=NullReporter(), persistent=persistent
+        )
+        run(mw, 100)
+        elapsed = run(mw, requests)
+        print("{0:<12} {1:>10.1f} req/s {2:>8.1f}us overhead".format(
+            "persistent" if persistent else "per-session",
+            1 / elapsed,
+            (elapsed - baseline) * 1e6,
+        ))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -3,10 +3,22 @@
 # these names by doing ``from easy_profile import SessionProfiler``,
 # for example.
 
-from .middleware import EasyProfileMiddleware
+from .aggregation import AggregateReporter
+from .exporters import JSONLinesReporter, OpenMetricsReporter, SpanReporter
+from .middleware import EasyProfileASGIMiddleware, EasyProfileMiddleware
 from .profiler import SessionProfiler
-from .reporters import StreamReporter
+from .reporters import QueuedReporter, StreamReporter
 
-__all__ = ["EasyProfileMiddleware", "SessionProfiler", "StreamReporter"]
+__all__ = [
+    "AggregateReporter",
+    "EasyProfileASGIMiddleware",
+    "EasyProfileMiddleware",
+    "JSONLinesReporter",
+    "OpenMetricsReporter",
+    "QueuedReporter",
+    "SessionProfiler",
+    "SpanReporter",
+    "StreamReporter",
+]
 __author__ = "Dmitry Vasilishin"
 __version__ = "1.3.0"
@@ -0,0 +1,287 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import heapq
+import itertools
+import math
+import sys
+import threading
+import time
+
+from .reporters import flush_at_exit, format_duration, Reporter
+
+# Upper bounds of duration buckets in seconds, from 100µs to ~105s
+DURATION_BOUNDS = tuple(0.0001 * 2 ** n for n in range(21))
+# Upper bounds of query count buckets, from 1 to 8192
+COUNT_BOUNDS = tuple(2 ** n for n in range(14))
+
+
+class Histogram:
+    """A histogram with fixed buckets, so it takes the same memory
+    regardless of the number of added values.
+
+    :param tuple bounds: sorted upper bounds of buckets, values greater
+        than the last bound are counted in an overflow bucket
+
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Estimates percentile as the upper bound of its bucket.
+
+        :param float percent: percentile from 0 to 100
+
+        :return: estimated value, it's never greater than the maximum
+
+        """
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _PathStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = Histogram(COUNT_BOUNDS)
+        self.duration = Histogram(DURATION_BOUNDS)
+
+
+class AggregateReporter(Reporter):
+    """A reporter which aggregates statistics of many reports by path and
+    by statement fingerprint, and periodically flushes a summary.
+
+    Every path keeps request count and histograms of query counts and
+    durations, statements keep execution count and total duration. The
+    memory is limited by ``max_paths`` and ``max_statements``, reports of
+    paths over the limit are aggregated under ``other_path``.
+
+    Statements over the limit are ranked by the Space-Saving algorithm:
+    a new statement replaces the one with the least total duration and
+    inherits its duration, so a newly hot statement can still enter the
+    top. Durations of replacing statements are overestimated at most by
+    the summary ``error``.
+
+    :param float flush_interval: seconds between flushes, flushes are
+        triggered by reports, ``None`` disables periodic flushing, the
+        last summary is flushed when the interpreter exits
+    :param on_flush: callable which accepts a summary dict, by default
+        the summary is written to ``file`` as text
+    :param file: output destination of text summaries (stdout by default)
+    :param int top: how much statements are included into a summary
+    :param int max_paths: maximum number of aggregated paths
+    :param int max_statements: maximum number of aggregated statements
+
+    """
+
+    other_path = "<other>"
+
+    def __init__(self,
+                 flush_interval=60,
+                 on_flush=None,
+                 file=sys.stdout,
+                 top=10,
+                 max_paths=1000,
+                 max_statements=1000):
+
+        self._flush_interval = flush_interval
+        self._on_flush = on_flush
+        self._file = file
+        self._top = top
+        self._max_paths = max_paths
+        self._max_statements = max_statements
+        self._lock = threading.Lock()
+        self._clear()
+        flush_at_exit(self)
+
+    def report(self, path, stats):
+        statements = stats.get("statements") or {}
+        with self._lock:
+            self._add(path, stats, statements)
+            flush = (
+                self._flush_interval is not None and
+                time.monotonic() - self._started >= self._flush_interval
+            )
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Flushes summary of aggregated statistics and starts a new
+        aggregation interval.
+
+        """
+        with self._lock:
+            summary = self._summary()
+            self._clear()
+
+        if self._on_flush is not None:
+            self._on_flush(summary)
+        elif summary["paths"]:
+            self._file.write(self.format_summary(summary))
+
+    def summary(self):
+        """Returns summary of aggregated statistics.
+
+        Durations are in seconds, percentiles are estimated by histogram
+        buckets.
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return self._summary()
+
+    def format_summary(self, summary):
+        """Formats summary as text.
+
+        :param dict summary: summary of aggregated statistics
+
+        :return: formatted summary
+        :rtype: str
+
+        """
+        lines = ["", "Profiling summary for {0}".format(
+            format_duration(summary["interval"])
+        )]
+        for path, path_stats in summary["paths"].items():
+            queries = path_stats["queries"]
+            duration = path_stats["duration"]
+            lines.append(
+                "{0}: {1} requests, queries p50/p95/p99 "
+                "{2}/{3}/{4}, duration p50/p95/p99 {5}/{6}/{7}".format(
+                    path,
+                    path_stats["requests"],
+                    queries["p50"],
+                    queries["p95"],
+                    queries["p99"],
+                    format_duration(duration["p50"]),
+                    format_duration(duration["p95"]),
+                    format_duration(duration["p99"]),
+                )
+            )
+        if summary["statements"]:
+            lines.append("Top statements:")
+        for entry in summary["statements"]:
+            lines.append("{0} times in {1}: {2}".format(
+                entry["count"],
+                format_duration(entry["duration"]),
+                entry["statement"],
+            ))
+        return "\n".join(lines) + "\n"
+
+    def _add(self, path, stats, statements):
+        path_stats = self._paths.get(path)
+        if path_stats is None:
+            if len(self._paths) >= self._max_paths:
+                path = self.other_path
+            path_stats = self._paths.setdefault(path, _PathStats())
+
+        path_stats.requests += 1
+        path_stats.queries.add(stats["total"])
+        path_stats.duration.add(stats["duration"])
+
+        for fingerprint, entry in statements.items():
+            aggregated = self._statements.get(fingerprint)
+            if aggregated is not None:
+                aggregated[1] += entry.count
+                aggregated[2] += entry.duration_ns
+                continue
+            error_ns = 0
+            if len(self._statements) >= self._max_statements:
+                error_ns = self._evict()
+            self._statements[fingerprint] = [
+                entry.statement, entry.count, entry.duration_ns + error_ns,
+                error_ns,
+            ]
+            heapq.heappush(self._heap, (
+                entry.duration_ns + error_ns, next(self._counter),
+                fingerprint,
+            ))
+
+    def _evict(self):
+        """Evicts the statement with the least total duration.
+
+        The heap is updated lazily, durations only grow, so an entry
+        whose duration is up to date is the minimum.
+
+        :return: total duration of the evicted statement in ns
+
+        """
+        while True:
+            duration_ns, _, fingerprint = heapq.heappop(self._heap)
+            aggregated = self._statements[fingerprint]
+            if aggregated[2] == duration_ns:
+                del self._statements[fingerprint]
+                return duration_ns
+            heapq.heappush(self._heap, (
+                aggregated[2], next(self._counter), fingerprint,
+            ))
+
+    def _summary(self):
+        paths = OrderedDict()
+        ordered = sorted(
+            self._paths.items(),
+            key=lambda item: item[1].duration.sum,
+            reverse=True,
+        )
+        for path, path_stats in ordered:
+            paths[path] = {
+                "requests": path_stats.requests,
+                "queries": self._summarize(path_stats.queries),
+                "duration": self._summarize(path_stats.duration),
+            }
+
+        top = sorted(
+            self._statements.values(),
+            key=lambda entry: entry[2],
+            reverse=True,
+        )[:self._top]
+        statements = [
+            {
+                "statement": statement,
+                "count": count,
+                "duration": duration_ns / 1e9,
+                "error": error_ns / 1e9,
+            }
+            for statement, count, duration_ns, error_ns in top
+        ]
+        return {
+            "interval": time.monotonic() - self._started,
+            "paths": paths,
+            "statements": statements,
+        }
+
+    def _clear(self):
+        self._paths = OrderedDict()
+        self._statements = {}
+        # Min-heap of statements by total duration, see ``_evict``
+        self._heap = []
+        self._counter = itertools.count()
+        self._started = time.monotonic()
+
+    @staticmethod
+    def _summarize(histogram):
+        return {
+            "count": histogram.count,
+            "sum": histogram.sum,
+            "max": histogram.max,
+            "p50": histogram.percentile(50),
+            "p95": histogram.percentile(95),
+            "p99": histogram.percentile(99),
+        }
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import logging
+import queue
+import threading
+import time
+import weakref
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AssertionPool, SingletonThreadPool, StaticPool
+
+logger = logging.getLogger(__name__)
+
+# Execution option of connections whose statements aren't profiled
+IGNORE_OPTION = "easy_profile_ignore"
+
+# Statement prefixes of dialects which don't use plain ``EXPLAIN``
+_EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+}
+
+# Pools which check out the same DBAPI connection the application uses,
+# e.g. for in-memory SQLite. Returning it to the pool would roll back
+# the transaction of the application.
+_SHARED_POOLS = (AssertionPool, SingletonThreadPool, StaticPool)
+
+# Errors of statements which can't be explained, other errors are caused
+# by the environment (e.g. lost connection) and aren't cached.
+_STATEMENT_ERRORS = (exc.NotSupportedError, exc.ProgrammingError)
+
+
+def is_explainable(engine):
+    """Checks if execution plans of the engine can be captured.
+
+    Engines whose pool shares a DBAPI connection between checkouts can't
+    be explained on a separate connection, and connections of async
+    dialects can't be used by the worker thread.
+
+    :param Engine engine: sqlalchemy engine
+
+    :rtype: bool
+
+    """
+    if getattr(engine.dialect, "is_async", False):
+        return False
+    return not isinstance(engine.pool, _SHARED_POOLS)
+
+
+class Explainer:
+    """Captures execution plans of statements out of band.
+
+    Plans are captured by a background worker thread on a separate
+    connection which is ignored by profilers, so ``explain`` returns a
+    cached plan or schedules the statement and returns ``None``, and its
+    plan is available to the next slow execution. Plans are cached by
+    statement fingerprint, so every statement is explained once, and new
+    statements are scheduled no more often than ``min_interval``.
+
+    Statements rejected by the database are cached without a plan,
+    failures caused by the environment are logged and the statement is
+    explained again later. Engines which aren't explainable (see
+    :func:`is_explainable`) are skipped.
+
+    :param int max_plans: maximum number of cached plans per engine
+    :param float min_interval: minimal seconds between two explanations
+    :param int max_pending: maximum number of statements waiting for
+        the worker, statements over the limit aren't explained
+
+    """
+
+    def __init__(self, max_plans=1000, min_interval=1.0, max_pending=100):
+        self.max_plans = max_plans
+        self.min_interval = min_interval
+        self._plans = weakref.WeakKeyDictionary()
+        self._pending = set()
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._last_time = None
+
+    def explain(self, engine, statement, parameters, fingerprint):
+        """Returns execution plan of the statement, the statement is
+        scheduled to be explained if its plan isn't cached yet.
+
+        :param Engine engine: engine which executed the statement
+        :param str statement: DBAPI statement
+        :param parameters: DBAPI parameters of the statement
+        :param str fingerprint: fingerprint of the statement
+
+        :return: plan as text or ``None`` if it isn't available yet,
+            explanations are rate limited or the engine isn't explainable
+
+        """
+        if not is_explainable(engine):
+            return None
+
+        key = (engine, fingerprint)
+        with self._lock:
+            plans = self._plans.setdefault(engine, OrderedDict())
+            if fingerprint in plans:
+                plans.move_to_end(fingerprint)
+                return plans[fingerprint]
+            if key in self._pending:
+                return None
+            now = time.monotonic()
+            if (self._last_time is not None and
+                    now - self._last_time < self.min_interval):
+                return None
+            self._last_time = now
+            self._pending.add(key)
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((engine, statement, parameters,
+                                    fingerprint))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+        return None
+
+    def join(self):
+        """Blocks until all scheduled statements are explained."""
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.join()
+
+    def clear(self):
+        """Clears cached plans and the rate limit."""
+        with self._lock:
+            self._plans = weakref.WeakKeyDictionary()
+            self._last_time = None
+
+    def _ensure_worker(self):
+        # The worker isn't alive in a forked process either
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="easy-profile-explainer",
+                    daemon=True,
+                )
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._capture(*item)
+            except Exception:
+                logger.exception("Failed to capture execution plan")
+            finally:
+                self._queue.task_done()
+
+    def _capture(self, engine, statement, parameters, fingerprint):
+        cached = True
+        try:
+            plan = self._explain(engine, statement, parameters)
+        except _STATEMENT_ERRORS:
+            logger.debug("Failed to explain statement", exc_info=True)
+            plan = None
+        except Exception:
+            logger.warning("Failed to explain statement", exc_info=True)
+            plan, cached = None, False
+
+        with self._lock:
+            self._pending.discard((engine, fingerprint))
+            if not cached:
+                return
+            plans = self._plans.setdefault(engine, OrderedDict())
+            plans[fingerprint] = plan
+            if len(plans) > self.max_plans:
+                plans.popitem(last=False)
+
+    @staticmethod
+    def _explain(engine, statement, parameters):
+        prefix = _EXPLAIN_PREFIXES.get(engine.dialect.name, "EXPLAIN ")
+        with engine.connect() as conn:
+            conn = conn.execution_options(**{IGNORE_OPTION: True})
+            rows = conn.exec_driver_sql(
+                prefix + statement, parameters or ()
+            ).fetchall()
+        return "\n".join(
+            " ".join(str(value) for value in row) for row in rows
+        )
+
+
+# Shared by profiling sessions which are created with ``explain=True``
+default_explainer = Explainer()
@@ -0,0 +1,335 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from .aggregation import COUNT_BOUNDS, DURATION_BOUNDS, Histogram
+from .profiler import _timer
+from .reporters import flush_at_exit, Reporter
+from .statements import classify, SQL_KINDS
+
+logger = logging.getLogger(__name__)
+
+# Compact encoder shared by exporters, unknown values are encoded as
+# strings, e.g. parameters of arbitrary types.
+_encode = json.JSONEncoder(
+    separators=(",", ":"), ensure_ascii=False, default=str
+).encode
+
+
+def _get_duplicates_count(stats):
+    duplicates = stats.get("duplicates")
+    return sum(duplicates.values()) if duplicates else 0
+
+
+class JSONLinesReporter(Reporter):
+    """A reporter which writes every report as a JSON object on its own
+    line, statements are neither formatted nor colorized.
+
+    :param file: output destination (stdout by default)
+    :param int batch_size: how much reports are buffered before they are
+        written at once, remaining reports are written by ``flush`` or
+        when the interpreter exits
+    :param bool include_statements: set True to include execution count
+        and duration of every statement
+
+    """
+
+    _keys = SQL_KINDS + [
+        "total",
+        "duration",
+        "rows_affected",
+        "rows_fetched",
+        "fetch_duration",
+    ]
+
+    def __init__(self, file=sys.stdout, batch_size=1,
+                 include_statements=False):
+        self._file = file
+        self._batch_size = batch_size
+        self._include_statements = include_statements
+        self._buffer = []
+        self._lock = threading.Lock()
+        if batch_size > 1:
+            flush_at_exit(self)
+
+    def report(self, path, stats):
+        line = _encode(self.serialize(path, stats)) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) < self._batch_size:
+                return
+            lines, self._buffer = self._buffer, []
+            self._file.write("".join(lines))
+
+    def flush(self):
+        """Writes buffered reports."""
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+            if lines:
+                self._file.write("".join(lines))
+
+    def serialize(self, path, stats):
+        """Returns JSON serializable representation of a report.
+
+        :param str path: where profiling occurred
+        :param dict stats: profiling statistics
+
+        :rtype: dict
+
+        """
+        record = {
+            "time": time.time(),
+            "path": path,
+            "db": stats.get("db"),
+        }
+        for key in self._keys:
+            record[key] = stats.get(key, 0)
+        record["duplicates"] = _get_duplicates_count(stats)
+        for key in ("repeats", "fanouts"):
+            counter = stats.get(key)
+            record[key] = sum(counter.values()) if counter else 0
+        record["slow_queries"] = [
+            {
+                "statement": query.statement,
+                "duration": query.duration,
+                "plan": plan,
+            }
+            for query, plan in stats.get("slow_queries", ())
+        ]
+        if self._include_statements:
+            record["statements"] = [
+                {
+                    "statement": entry.statement,
+                    "count": entry.count,
+                    "duration": entry.duration_ns / 1e9,
+                }
+                for entry in (stats.get("statements") or {}).values()
+            ]
+        return record
+
+
+def _escape_label(value):
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+class _PathMetrics:
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = dict.fromkeys(SQL_KINDS, 0)
+        self.duplicates = 0
+        self.query_count = Histogram(COUNT_BOUNDS)
+        self.duration = Histogram(DURATION_BOUNDS)
+
+
+class OpenMetricsReporter(Reporter):
+    """A reporter which collects per path counters and histograms and
+    exposes them in the OpenMetrics text format, e.g. to be served on a
+    Prometheus scrape endpoint.
+
+    Metrics are cumulative, paths over ``max_paths`` are collected under
+    ``other_path``.
+
+    :param str prefix: prefix of metric names
+    :param int max_paths: maximum number of paths with own metrics
+
+    """
+
+    other_path = "<other>"
+
+    def __init__(self, prefix="easy_profile", max_paths=1000):
+        self._prefix = prefix
+        self._max_paths = max_paths
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def report(self, path, stats):
+        duplicates = _get_duplicates_count(stats)
+        with self._lock:
+            metrics = self._paths.get(path)
+            if metrics is None:
+                if len(self._paths) >= self._max_paths:
+                    path = self.other_path
+                metrics = self._paths.setdefault(path, _PathMetrics())
+            metrics.requests += 1
+            for kind in SQL_KINDS:
+                metrics.queries[kind] += stats.get(kind, 0)
+            metrics.duplicates += duplicates
+            metrics.query_count.add(stats["total"])
+            metrics.duration.add(stats["duration"])
+
+    def expose(self):
+        """Returns collected metrics in the OpenMetrics text format.
+
+        :rtype: str
+
+        """
+        prefix = self._prefix
+        requests = ["# TYPE {0}_requests counter".format(prefix)]
+        queries = ["# TYPE {0}_queries counter".format(prefix)]
+        duplicates = ["# TYPE {0}_duplicate_queries counter".format(prefix)]
+        query_count = ["# TYPE {0}_request_queries histogram".format(prefix)]
+        duration = [
+            "# TYPE {0}_request_query_duration_seconds histogram".format(
+                prefix
+            )
+        ]
+        with self._lock:
+            for path, metrics in self._paths.items():
+                label = 'path="{0}"'.format(_escape_label(path))
+                requests.append("{0}_requests_total{{{1}}} {2}".format(
+                    prefix, label, metrics.requests
+                ))
+                for kind, count in metrics.queries.items():
+                    queries.append(
+                        '{0}_queries_total{{{1},kind="{2}"}} {3}'.format(
+                            prefix, label, kind, count
+                        )
+                    )
+                duplicates.append(
+                    "{0}_duplicate_queries_total{{{1}}} {2}".format(
+                        prefix, label, metrics.duplicates
+                    )
+                )
+                query_count.extend(self._histogram(
+                    prefix + "_request_queries", label, metrics.query_count
+                ))
+                duration.extend(self._histogram(
+                    prefix + "_request_query_duration_seconds",
+                    label,
+                    metrics.duration,
+                ))
+        lines = requests + queries + duplicates + query_count + duration
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram(name, label, histogram):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            cumulative += count
+            lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                name, label, repr(float(bound)), cumulative
+            ))
+        lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(
+            name, label, histogram.count
+        ))
+        lines.append("{0}_count{{{1}}} {2}".format(
+            name, label, histogram.count
+        ))
+        lines.append("{0}_sum{{{1}}} {2}".format(name, label, histogram.sum))
+        return lines
+
+
+class SpanReporter(Reporter):
+    """A reporter which exports a span per captured query, as children
+    of a span of the profiled path, to a local collector.
+
+    Spans are JSON objects with OTLP field names and flat attributes,
+    they are written as lines to ``file`` or sent as UDP datagrams to
+    ``address``. Only queries retained in the call stack are exported.
+
+    :param file: output destination of spans
+    :param tuple address: host and port of a UDP collector, it's used
+        instead of ``file``
+    :param str service_name: name of the service added to every span
+    :param bool include_parameters: set True to export query parameters
+
+    :attr int dropped: number of spans which weren't sent
+
+    """
+
+    def __init__(self, file=None, address=None, service_name=None,
+                 include_parameters=False):
+        if (file is None) == (address is None):
+            raise ValueError("Either file or address must be specified")
+
+        self._file = file
+        self._address = address
+        self._service_name = service_name
+        self._include_parameters = include_parameters
+        self._socket = None
+        if address is not None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._lock = threading.Lock()
+        # Converts query timestamps of the monotonic profiler clock to
+        # nanoseconds since the epoch.
+        self._clock_offset = time.time_ns() - _timer()
+        self.dropped = 0
+
+    def report(self, path, stats):
+        spans = self.create_spans(path, stats)
+        if self._socket is not None:
+            for span in spans:
+                try:
+                    self._socket.sendto(
+                        _encode(span).encode("utf-8"), self._address
+                    )
+                except OSError:
+                    self.dropped += 1
+            return
+        output = "".join(_encode(span) + "\n" for span in spans)
+        with self._lock:
+            self._file.write(output)
+
+    def close(self):
+        """Closes the socket of the UDP collector."""
+        if self._socket is not None:
+            self._socket.close()
+
+    def create_spans(self, path, stats):
+        """Returns spans of the path and its queries.
+
+        :param str path: where profiling occurred
+        :param dict stats: profiling statistics
+
+        :rtype: list
+
+        """
+        queries = stats.get("call_stack") or []
+        if not queries:
+            return []
+        offset = self._clock_offset
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        attributes = {"db.name": stats.get("db"), "db.queries": stats["total"]}
+        if self._service_name is not None:
+            attributes["service.name"] = self._service_name
+        spans = [{
+            "traceId": trace_id,
+            "spanId": root_id,
+            "name": path,
+            "startTimeUnixNano": queries[0].start_time + offset,
+            "endTimeUnixNano": max(q.end_time for q in queries) + offset,
+            "attributes": attributes,
+        }]
+        for query in queries:
+            info = classify(query.statement)
+            attributes = {
+                "db.statement": query.statement,
+                "db.operation": info.kind,
+            }
+            if self._include_parameters:
+                attributes["db.parameters"] = query.parameters
+            if query.callsite is not None:
+                attributes["code.filepath"] = query.callsite.filename
+                attributes["code.lineno"] = query.callsite.lineno
+                attributes["code.function"] = query.callsite.function
+            spans.append({
+                "traceId": trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": info.kind,
+                "startTimeUnixNano": query.start_time + offset,
+                "endTimeUnixNano": query.end_time + offset,
+                "attributes": attributes,
+            })
+        return spans
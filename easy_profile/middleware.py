@@ -1,8 +1,65 @@
+import functools
+import random
 import re
 
-from .profiler import SessionProfiler
+from .profiler import _timer, SessionProfiler
 from .reporters import Reporter, StreamReporter
 
+# Group references are renumbered when patterns are combined
+_GROUP_REFERENCE_REGEX = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def _compile_patterns(patterns):
+    """Compiles regex patterns into a single matching function.
+
+    Patterns are combined into one alternation, so a path is matched in
+    a single pass. Patterns which can't be combined, e.g. with group
+    references or global flags, are matched one by one.
+
+    :param list patterns: regex patterns
+    :return: function which returns True if any pattern matches a path
+
+    """
+    patterns = list(patterns)
+    if not patterns:
+        return lambda path: False
+    if not any(_GROUP_REFERENCE_REGEX.search(p) for p in patterns):
+        try:
+            regex = re.compile("|".join(
+                "(?:{0})".format(pattern) for pattern in patterns
+            ))
+        except re.error:
+            pass
+        else:
+            return lambda path: regex.match(path) is not None
+    regexes = [re.compile(pattern) for pattern in patterns]
+    return lambda path: any(regex.match(path) for regex in regexes)
+
+
+class _ProfiledResponse:
+    """Wraps WSGI response iterable and calls back when it's closed.
+
+    :param response: WSGI response iterable
+    :param collections.abc.Callable callback: called once on close
+
+    """
+
+    def __init__(self, response, callback):
+        self._response = response
+        self._callback = callback
+
+    def __iter__(self):
+        return iter(self._response)
+
+    def close(self):
+        callback, self._callback = self._callback, None
+        try:
+            if hasattr(self._response, "close"):
+                self._response.close()
+        finally:
+            if callback is not None:
+                callback()
+
 
 class EasyProfileMiddleware(object):
     """This middleware prints the number of database queries for each HTTP
@@ -11,19 +68,56 @@ class EasyProfileMiddleware(object):
     :param app: WSGI application server
     :param sqlalchemy.engine.base.Engine engine: sqlalchemy database engine
     :param Reporter reporter: reporter instance
-    :param list exclude_path: a list of regex patterns for excluding requests
+    :param list exclude_path: a list of regex patterns for excluding requests,
+        they are compiled once and recent decisions are cached by path
     :param int min_time: minimal queries duration to logging
     :param int min_query_count: minimal queries count to logging
+    :param bool persistent: set True if profiler listeners should be
+        installed once per engine instead of on every request
+    :param bool context_local: set True if every request should collect
+        only queries executed by its own thread, it's recommended for
+        multi-threaded servers and implies persistent listeners
+    :param dict profiler_options: extra keyword arguments of
+        :class:`SessionProfiler`, e.g. ``{"max_queries": 100}``
+    :param float sample_rate: fraction of requests which are profiled
+    :param dict path_sample_rates: sample rates by regex patterns of paths,
+        the first matching pattern overrides ``sample_rate``
+    :param str force_header: name of the request header which forces
+        profiling of the request regardless of sampling
+    :param float overhead_budget: maximum fraction of requests time spent
+        by the profiler, including its cursor listeners, the sample rate is
+        lowered adaptively when the measured overhead exceeds it
+    :param int exclude_cache_size: how much recent paths are cached with
+        their exclusion decisions, ``0`` disables caching
+
+    :attr float adaptive_rate: the highest sample rate which fits into
+        the overhead budget
 
     """
 
+    # Smoothing factor of the measured profiler overhead
+    _overhead_alpha = 0.1
+
     def __init__(self,
                  app,
                  engine=None,
                  reporter=None,
                  exclude_path=None,
                  min_time=0,
-                 min_query_count=1):
+                 min_query_count=1,
+                 persistent=False,
+                 context_local=False,
+                 profiler_options=None,
+                 sample_rate=1.0,
+                 path_sample_rates=None,
+                 force_header=None,
+                 overhead_budget=None,
+                 exclude_cache_size=1024):
+
+        path_sample_rates = path_sample_rates or {}
+        for rate in [sample_rate, *path_sample_rates.values()]:
+            if not 0 <= rate <= 1:
+                raise ValueError("Sample rate must be between 0 and 1")
 
         if reporter:
             if not isinstance(reporter, Reporter):
@@ -34,30 +128,176 @@ class EasyProfileMiddleware(object):
 
         self.app = app
         self.engine = engine
+        self._exclude_cache_size = exclude_cache_size
         self.exclude_path = exclude_path or []
         self.min_time = min_time
         self.min_query_count = min_query_count
+        self.persistent = persistent
+        self.context_local = context_local
+        self.profiler_options = profiler_options or {}
+        self.sample_rate = sample_rate
+        self.path_sample_rates = [
+            (re.compile(pattern), rate)
+            for pattern, rate in path_sample_rates.items()
+        ]
+        self.force_header = force_header
+        self.overhead_budget = overhead_budget
+        self.adaptive_rate = 1.0
+
+        self._overhead = 0.0
+        if force_header:
+            self._force_key = "HTTP_" + force_header.upper().replace("-", "_")
+        else:
+            self._force_key = None
 
     def __call__(self, environ, start_response):
-        profiler = SessionProfiler(self.engine)
         path = environ.get("PATH_INFO", "")
-        if not self._ignore_request(path):
+        forced = self._force_key is not None and self._force_key in environ
+        if not self._ignore_request(path) and self._sample(path, forced):
             method = environ.get("REQUEST_METHOD")
             if method:
                 path = "{0} {1}".format(method, path)
+            profiler, started, overhead = self._begin()
             try:
-                with profiler:
-                    response = self.app(environ, start_response)
-            finally:
-                self._report_stats(path, profiler.stats)
-            return response
+                response = self.app(environ, start_response)
+            except BaseException:
+                self._commit(profiler, path, started, overhead)
+                raise
+            # Streamed responses execute queries while the server iterates
+            # them, so the session is committed when the response is closed.
+            if isinstance(response, (list, tuple)):
+                self._commit(profiler, path, started, overhead)
+                return response
+            return _ProfiledResponse(response, functools.partial(
+                self._commit, profiler, path, started, overhead
+            ))
         return self.app(environ, start_response)
 
+    def _sample(self, path, forced=False):
+        """Check to see if the request should be profiled."""
+        if forced:
+            return True
+        rate = self.sample_rate
+        for regex, path_rate in self.path_sample_rates:
+            if regex.match(path):
+                rate = path_rate
+                break
+        if self.overhead_budget is not None:
+            rate = min(rate, self.adaptive_rate)
+        return rate >= 1 or random.random() < rate
+
+    def _begin(self):
+        """Begins profiling session of a request.
+
+        :return: profiler, start time and overhead of the session in ns
+
+        """
+        profiler = self._create_profiler()
+        started = _timer()
+        profiler.begin()
+        return profiler, started, _timer() - started
+
+    def _commit(self, profiler, path, started, overhead):
+        commit_started = _timer()
+        try:
+            profiler.commit()
+        finally:
+            report_started = _timer()
+            self._report_stats(path, profiler.stats)
+            finished = _timer()
+            profiler._add_report_time(finished - report_started)
+            if self.overhead_budget is not None:
+                # Listeners run during the request, the rest after it
+                overhead += finished - commit_started
+                overhead += profiler.stats["overhead"]["listener_ns"]
+                self._update_overhead(overhead, finished - started)
+
+    def _update_overhead(self, overhead, elapsed):
+        """Updates smoothed overhead fraction and the adaptive sample rate.
+
+        :param int overhead: time spent by the profiler in ns
+        :param int elapsed: request time in ns
+
+        """
+        if elapsed <= 0:
+            return
+        alpha = self._overhead_alpha
+        self._overhead += alpha * (overhead / elapsed - self._overhead)
+        # Overhead of all requests is proportional to the sample rate
+        if self._overhead > self.overhead_budget:
+            self.adaptive_rate = self.overhead_budget / self._overhead
+        else:
+            self.adaptive_rate = 1.0
+
+    def _create_profiler(self):
+        return SessionProfiler(
+            self.engine,
+            persistent=self.persistent,
+            context_local=self.context_local,
+            **self.profiler_options
+        )
+
+    @property
+    def exclude_path(self):
+        return self._exclude_path
+
+    @exclude_path.setter
+    def exclude_path(self, patterns):
+        """Compiles patterns, assign a new list to change them."""
+        self._exclude_path = patterns
+        match = _compile_patterns(patterns)
+        if self._exclude_cache_size:
+            match = functools.lru_cache(self._exclude_cache_size)(match)
+        self._match_exclude_path = match
+
     def _ignore_request(self, path):
         """Check to see if we should ignore the request."""
-        return any(re.match(pattern, path) for pattern in self.exclude_path)
+        return self._match_exclude_path(path)
 
     def _report_stats(self, path, stats):
         if (stats["total"] >= self.min_query_count and
                 stats["duration"] >= self.min_time):
             self.reporter.report(path, stats)
+
+
+class EasyProfileASGIMiddleware(EasyProfileMiddleware):
+    """This middleware prints the number of database queries for each HTTP
+    request and can be applied as an ASGI application middleware.
+
+    Requests are handled concurrently in a single thread, that's why
+    profiling sessions are context local by default, so every request
+    collects only queries executed by its own asyncio task. Accepts the
+    same parameters as :class:`EasyProfileMiddleware`.
+
+    :param app: ASGI application
+    :param AsyncEngine engine: sqlalchemy database engine
+
+    """
+
+    def __init__(self, app, engine=None, context_local=True, **kwargs):
+        super().__init__(
+            app, engine=engine, context_local=context_local, **kwargs
+        )
+        if self.force_header:
+            self._force_key = self.force_header.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (scope["type"] != "http" or self._ignore_request(path) or
+                not self._sample(path, self._is_forced(scope))):
+            return await self.app(scope, receive, send)
+
+        method = scope.get("method")
+        if method:
+            path = "{0} {1}".format(method, path)
+        profiler, started, overhead = self._begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._commit(profiler, path, started, overhead)
+
+    def _is_forced(self, scope):
+        if self._force_key is None:
+            return False
+        headers = scope.get("headers", ())
+        return any(key == self._force_key for key, _ in headers)
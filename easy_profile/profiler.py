@@ -1,25 +1,67 @@
-from collections import Counter, namedtuple, OrderedDict
+from collections import Counter, deque, namedtuple, OrderedDict
+from collections.abc import ItemsView, KeysView, ValuesView
+from contextvars import ContextVar
 import functools
+import hashlib
 import inspect
-from queue import Queue
-import re
+from operator import attrgetter
+import random
 import sys
+import threading
 import time
+import weakref
 
+try:
+    import greenlet
+except ImportError:  # pragma: no cover
+    greenlet = None
 from sqlalchemy import event
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.sql.compiler import SQLCompiler
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.util import find_tables
 
+from . import statements
+from .explain import default_explainer, IGNORE_OPTION, is_explainable
 from .reporters import StreamReporter
+from .statements import classify, SQL_KINDS, SQL_OPERATORS  # noqa: F401
 
-# Optimize timer function for the platform
-if sys.platform == "win32":  # pragma: no cover
-    _timer = time.perf_counter
-else:
-    _timer = time.time
+# Monotonic high resolution clock with integer nanoseconds, it isn't
+# affected by system clock updates and durations are summed as integers.
+_timer = time.perf_counter_ns
 
 
-SQL_OPERATORS = ["select", "insert", "update", "delete"]
-OPERATOR_REGEX = re.compile("(%s) *." % "|".join(SQL_OPERATORS), re.IGNORECASE)
+def _calibrate_timer(samples=1000):
+    """Returns the least measured cost of reading the clock in ns."""
+    cost = None
+    for _ in range(samples):
+        start = _timer()
+        elapsed = _timer() - start
+        if cost is None or elapsed < cost:
+            cost = elapsed
+    return cost
+
+
+# Subtracted from query durations by sessions created with
+# ``subtract_overhead=True``
+_TIMER_COST_NS = _calibrate_timer()
+
+OverheadInfo = namedtuple(
+    "OverheadInfo", "sessions,queries,listener_ns,stats_ns,report_ns"
+)
+
+# Profiler overhead of all committed sessions, fields of OverheadInfo
+_overhead = [0, 0, 0, 0, 0]
+_overhead_lock = threading.Lock()
+
+
+def _add_overhead(sessions=0, queries=0, listener_ns=0, stats_ns=0,
+                  report_ns=0):
+    with _overhead_lock:
+        for index, value in enumerate(
+            (sessions, queries, listener_ns, stats_ns, report_ns)
+        ):
+            _overhead[index] += value
 
 
 def _get_object_name(obj):
@@ -31,44 +73,561 @@ def _get_object_name(obj):
     return module + "." + name
 
 
+Callsite = namedtuple("Callsite", "filename,lineno,function")
+
+# Frames of these packages are skipped when looking for a call site
+_SKIPPED_PACKAGES = ("sqlalchemy", "easy_profile")
+# Maximum number of cached code objects and locations
+_CALLSITE_CACHE_SIZE = 10000
+
+_skipped_codes = {}
+_callsites = {}
+
+
+def _is_skipped(code, module):
+    skipped = _skipped_codes.get(code)
+    if skipped is None:
+        package = (module or "").partition(".")[0]
+        skipped = package in _SKIPPED_PACKAGES
+        if len(_skipped_codes) >= _CALLSITE_CACHE_SIZE:
+            _skipped_codes.clear()
+        _skipped_codes[code] = skipped
+    return skipped
+
+
+def _get_callsite():
+    """Returns location of the first frame outside of sqlalchemy and
+    easy_profile, locations are cached by code object and line. Frames
+    of parent greenlets are searched too.
+
+    :rtype: Callsite
+
+    """
+    frame = sys._getframe(1)
+    current = None
+    while True:
+        if frame is None:
+            # Statements of an ``AsyncEngine`` are executed by a greenlet
+            # whose parent runs the awaiting coroutine
+            if greenlet is None:
+                return None
+            current = (current or greenlet.getcurrent()).parent
+            if current is None:
+                return None
+            frame = current.gr_frame
+            continue
+        code = frame.f_code
+        if not _is_skipped(code, frame.f_globals.get("__name__")):
+            key = (code, frame.f_lineno)
+            callsite = _callsites.get(key)
+            if callsite is None:
+                callsite = Callsite(
+                    code.co_filename, frame.f_lineno, code.co_name
+                )
+                if len(_callsites) >= _CALLSITE_CACHE_SIZE:
+                    _callsites.clear()
+                _callsites[key] = callsite
+            return callsite
+        frame = frame.f_back
+
+
+class FetchStats:
+    """Rows fetched from a cursor and time spent fetching them, it's
+    updated until the result is exhausted or closed.
+
+    """
+
+    __slots__ = ("rows", "duration_ns")
+
+    def __init__(self):
+        self.rows = 0
+        self.duration_ns = 0
+
+    def __repr__(self):
+        return "FetchStats(rows={0}, duration_ns={1})".format(
+            self.rows, self.duration_ns
+        )
+
+    @property
+    def duration(self):
+        """Fetching duration in seconds."""
+        return self.duration_ns / 1e9
+
+
+class _FetchCursor:
+    """DBAPI cursor proxy which measures fetched rows and fetching time.
+
+    :param cursor: DBAPI cursor
+    :param FetchStats fetch: updated fetch statistics
+
+    """
+
+    __slots__ = ("_cursor", "fetch")
+
+    def __init__(self, cursor, fetch):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "fetch", fetch)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def fetchone(self):
+        start_time = _timer()
+        row = self._cursor.fetchone()
+        self.fetch.duration_ns += _timer() - start_time
+        if row is not None:
+            self.fetch.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start_time = _timer()
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self.fetch.duration_ns += _timer() - start_time
+        self.fetch.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start_time = _timer()
+        rows = self._cursor.fetchall()
+        self.fetch.duration_ns += _timer() - start_time
+        self.fetch.rows += len(rows)
+        return rows
+
+
 _DebugQuery = namedtuple(
-    "_DebugQuery", "statement,parameters,start_time,end_time"
+    "_DebugQuery",
+    "statement,parameters,start_time,end_time,callsite,rowcount,fetch",
+    defaults=(None, None, None),
 )
 
 
 class DebugQuery(_DebugQuery):
-    """Public implementation of the debug query class"""
+    """Public implementation of the debug query class.
+
+    Start and end times are monotonic clock readings in nanoseconds,
+    the call site is captured only by sessions created with
+    ``callsites=True``. Sessions created with ``fetches=True`` record
+    the cursor row count and :class:`FetchStats` of queries returning
+    rows.
+
+    """
+
+    __slots__ = ()
 
     @property
-    def duration(self):
+    def duration_ns(self):
         return self.end_time - self.start_time
 
+    @property
+    def duration(self):
+        """Query duration in seconds."""
+        return self.duration_ns / 1e9
+
+
+class Stats(OrderedDict):
+    """Profiling statistics. Expensive derived values are registered
+    as factories and computed only on first access, lazy keys are
+    included into iteration, comparison and serialization.
+
+    Values are recomputed on every access until the statistics are
+    frozen by committing the session, and cached afterwards.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Lazy keys are never stored in the dict itself
+        self._factories = OrderedDict()
+        self._values = {}
+        self.frozen = False
+        super().__init__(*args, **kwargs)
+
+    def __missing__(self, key):
+        factory = self._factories[key]
+        if not self.frozen:
+            return factory()
+        value = self._values.get(key, _missing)
+        if value is _missing:
+            value = self._values[key] = factory()
+        return value
+
+    def __delitem__(self, key):
+        if super().__contains__(key):
+            super().__delitem__(key)
+        else:
+            del self._factories[key]
+            self._values.pop(key, None)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self._factories
+
+    def __iter__(self):
+        yield from super().__iter__()
+        yield from self._lazy_keys()
+
+    def __reversed__(self):
+        yield from reversed(self._lazy_keys())
+        yield from super().__reversed__()
+
+    def __len__(self):
+        return super().__len__() + len(self._lazy_keys())
+
+    def _lazy_keys(self):
+        # Assigned values take precedence over factories
+        contains = super().__contains__
+        return [key for key in self._factories if not contains(key)]
+
+    def __eq__(self, other):
+        if isinstance(other, OrderedDict):
+            return list(self.items()) == list(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, list(self.items()))
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super().pop(key, *default)
+
+    def copy(self):
+        return OrderedDict(self.items())
+
+    def __reduce__(self):
+        return OrderedDict, (list(self.items()),)
+
+    def lazy(self, key, factory):
+        """Registers factory of the value which is computed on first access.
+
+        :param str key: statistics key
+        :param collections.abc.Callable factory: callable without arguments
+
+        """
+        super().pop(key, None)
+        self._values.pop(key, None)
+        self._factories[key] = factory
+
+    def freeze(self):
+        """Caches lazy values from now on, statistics of a committed
+        session don't change anymore.
+
+        """
+        self.frozen = True
+
+
+_missing = object()
+
+
+# Repeats are executions with parameters which were executed before,
+# fanouts are executions with new parameters after the first one.
+StatementStats = namedtuple(
+    "StatementStats",
+    "statement,count,duration_ns,repeats,repeats_duration_ns,"
+    "fanouts,fanouts_duration_ns",
+    defaults=(0, 0, 0, 0),
+)
+CallsiteStats = namedtuple("CallsiteStats", "count,duration_ns")
+TableStats = namedtuple("TableStats", "count,duration_ns,rows")
+
+SlowQuery = namedtuple("SlowQuery", "query,plan")
+
+# Statement kinds which are explained
+_EXPLAIN_KINDS = frozenset(["select", "cte"])
+
+
+# Maximum number of remembered parameter sets per statement, executions
+# with parameters over the limit are considered as fanouts.
+_MAX_PARAMETER_KEYS = 1000
+
+
+def _get_parameters_key(statement, parameters, executemany=False):
+    """Returns a digest of the statement with its parameters.
+
+    Digests are compared instead of hashes, so different parameters
+    aren't mistaken for repeats by colliding hashes, and their size
+    doesn't depend on the size of the statement and parameters.
+
+    :return: 16 bytes digest or ``None`` for ``executemany`` queries,
+        which are considered as unique
+
+    """
+    if executemany:
+        return None
+    if isinstance(parameters, dict):
+        parameters = tuple(parameters.items())
+    key = repr((statement, parameters)).encode("utf-8", "replace")
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+
+def _get_duplicates(statements):
+    return Counter({entry[0]: entry[1] - 1 for entry in statements.values()})
+
+
+def _get_repeats(statements):
+    return Counter({entry[0]: entry[3] for entry in statements.values()})
+
+
+def _get_fanouts(statements):
+    return Counter({entry[0]: entry[5] for entry in statements.values()})
+
+
+def _get_statements(statements):
+    return OrderedDict(
+        (fingerprint, StatementStats(*entry[:7]))
+        for fingerprint, entry in statements.items()
+    )
+
+
+def _get_callsites(callsites):
+    ordered = sorted(callsites.items(), key=lambda item: item[1][1],
+                     reverse=True)
+    return OrderedDict(
+        (callsite, CallsiteStats(*entry)) for callsite, entry in ordered
+    )
+
+
+def _get_table_stats(tables):
+    ordered = sorted(tables.items(), key=lambda item: item[1][1],
+                     reverse=True)
+    return OrderedDict((name, TableStats(*entry)) for name, entry in ordered)
+
+
+# Names of tables by compiled statement, compiled statements are cached
+# by sqlalchemy and shared by executions of equal statements
+_compiled_tables = weakref.WeakKeyDictionary()
+
+
+def _get_tables(context, info):
+    """Returns names of tables referenced by the executed statement,
+    they are taken from the compiled statement and extracted from the
+    text of textual and driver level statements.
+
+    """
+    compiled = context.compiled
+    if (not isinstance(compiled, SQLCompiler) or
+            isinstance(compiled.statement, TextClause)):
+        return info.tables
+    tables = _compiled_tables.get(compiled)
+    if tables is None:
+        tables = _compiled_tables[compiled] = tuple(OrderedDict.fromkeys(
+            table.fullname
+            for table in find_tables(compiled.statement, include_crud=True)
+        ))
+    return tables
+
+
+def _get_model(context):
+    """Returns class name of the ORM entity of the executed statement."""
+    compiled = context.compiled
+    if compiled is None:
+        return None
+    subject = compiled.statement._propagate_attrs.get("plugin_subject")
+    mapper = getattr(subject, "mapper", None)
+    if mapper is None:
+        return None
+    return mapper.class_.__name__
+
+
+class _Dispatcher:
+    """Cursor event listeners which are installed once per engine.
+
+    Executed statements are routed to the profiling sessions attached
+    at the moment, so beginning and committing a persistent session
+    doesn't mutate the sqlalchemy event registry. Context local sessions
+    are kept in a context variable and receive only statements executed
+    by their own thread or asyncio task.
+
+    :param target: sqlalchemy engine or ``Engine`` class
+
+    """
+
+    def __init__(self, target):
+        self.sessions = ()
+        self._lock = threading.Lock()
+        self._local = ContextVar("easy_profile_sessions", default=())
+
+        event.listen(target, SessionProfiler._before,
+                     self._before_cursor_execute)
+        event.listen(target, SessionProfiler._after,
+                     self._after_cursor_execute)
+
+    def attach(self, session):
+        if session.context_local:
+            self._local.set(self._local.get() + (session,))
+            return
+        with self._lock:
+            self.sessions += (session,)
+
+    def detach(self, session):
+        if session.context_local:
+            local = self._local.get()
+            self._local.set(tuple(s for s in local if s is not session))
+            return
+        with self._lock:
+            self.sessions = tuple(s for s in self.sessions if s is not session)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        entered = _timer()
+        if ((self.sessions or self._local.get()) and
+                not context.execution_options.get(IGNORE_OPTION)):
+            start_time = context._query_start_time = _timer()
+            context._query_before_ns = start_time - entered
+            # Batches of executemany share the execution context
+            context._query_after_ns = 0
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        sessions = self.sessions + self._local.get()
+        if not sessions or not hasattr(context, "_query_start_time"):
+            return
+        for session in sessions:
+            session._after_cursor_execute(conn, cursor, statement,
+                                          parameters, context, executemany)
+
+
+_dispatchers = weakref.WeakKeyDictionary()
+_dispatchers_lock = threading.Lock()
+
+
+def _get_dispatcher(target):
+    """Returns the dispatcher of the target, installing it on first use."""
+    dispatcher = _dispatchers.get(target)
+    if dispatcher is None:
+        with _dispatchers_lock:
+            dispatcher = _dispatchers.get(target)
+            if dispatcher is None:
+                dispatcher = _dispatchers[target] = _Dispatcher(target)
+    return dispatcher
+
 
 class SessionProfiler:
     """A session profiler for sqlalchemy queries.
 
-    :param Engine engine: sqlalchemy database engine
+    :param Engine engine: sqlalchemy database engine, an ``AsyncEngine`` is
+        profiled through its synchronous engine
+    :param bool persistent: set True if the cursor listeners should be
+        installed once per engine and shared between profiling sessions,
+        instead of being added on ``begin`` and removed on ``commit``
+    :param bool context_local: set True if the session should collect only
+        queries executed by the thread or asyncio task which has begun it,
+        context local sessions always use persistent listeners
+    :param int max_queries: maximum number of queries retained in the
+        call stack, statistics counters and duration are exact anyway
+    :param str sampling: how the call stack is sampled when it's limited,
+        ``"ring"`` retains the latest queries and ``"reservoir"`` retains
+        a uniform random sample of all queries
+    :param int max_parameters: maximum number of retained parameter sets
+        of ``executemany`` queries, ``0`` drops parameters of all queries
+    :param float slow_query_time: queries which take at least this number
+        of seconds are collected in ``stats["slow_queries"]``
+    :param explain: set True to capture execution plans of slow ``SELECT``
+        queries in the background, or pass a
+        :class:`easy_profile.explain.Explainer` to configure caching and
+        rate limiting of plans
+    :param bool callsites: set True to capture the application code which
+        has executed every query, statistics by call site are available
+        in ``stats["callsites"]``
+    :param bool fetches: set True to measure rows affected by queries,
+        rows fetched from their results and time spent fetching them
+    :param bool table_stats: set True to aggregate queries by referenced
+        tables and ORM models in ``stats["tables"]`` and
+        ``stats["models"]``
+    :param bool subtract_overhead: set True to subtract time spent by
+        listeners of other sessions and the cost of reading the clock
+        from query durations
 
     :attr bool alive: is True if profiling in progress
-    :attr Queue queries: sqlalchemy queries queue
+    :attr list queries: sqlalchemy queries captured by the session
 
     """
 
     _before = "before_cursor_execute"
     _after = "after_cursor_execute"
 
-    def __init__(self, engine=None):
+    _samplings = ("ring", "reservoir")
+
+    def __init__(self,
+                 engine=None,
+                 persistent=False,
+                 context_local=False,
+                 max_queries=None,
+                 sampling="ring",
+                 max_parameters=None,
+                 slow_query_time=None,
+                 explain=False,
+                 callsites=False,
+                 fetches=False,
+                 table_stats=False,
+                 subtract_overhead=False):
+
+        if sampling not in self._samplings:
+            raise ValueError("Sampling must be one of {0}".format(
+                ", ".join(self._samplings)
+            ))
+        if explain and engine is not None and not is_explainable(
+            getattr(engine, "sync_engine", engine)
+        ):
+            raise ValueError(
+                "Execution plans can't be captured for async engines and "
+                "engines whose pool shares a single connection"
+            )
+
         if engine is None:
             self.engine = Engine
             self.db_name = "default"
         else:
-            self.engine = engine
+            # Async engines delegate execution to a synchronous engine
+            # which emits the cursor events.
+            self.engine = getattr(engine, "sync_engine", engine)
             self.db_name = engine.url.database or "undefined"
 
+        self.persistent = persistent or context_local
+        self.context_local = context_local
+        self.max_queries = max_queries
+        self.sampling = sampling
+        self.max_parameters = max_parameters
+        self.slow_query_time = slow_query_time
+        if explain is True:
+            explain = default_explainer
+        self.explainer = explain or None
+        self.callsites = callsites
+        self.fetches = fetches
+        self.table_stats = table_stats
+        self.subtract_overhead = subtract_overhead
         self.alive = False
         self.queries = None
 
         self._stats = None
+        self._slow_queries = []
+        self._listener_ns = 0
+        # Guards statistics updated by queries of concurrent threads
+        self._lock = threading.Lock()
 
     def __enter__(self):
         self.begin()
@@ -76,11 +635,18 @@ class SessionProfiler:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.commit()
 
+    async def __aenter__(self):
+        self.begin()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.commit()
+
     def __call__(self, path=None, path_callback=None, reporter=None):
         """Decorate callable object and profile sqlalchemy queries.
 
         If reporter was not defined by default will be used a base
-        streaming reporter.
+        streaming reporter. Coroutine functions are decorated with
+        a coroutine function.
 
         :param easy_profile.reporters.Reporter reporter: profiling reporter
         :param collections.abc.Callable path_callback: callback for getting
@@ -92,25 +658,65 @@ class SessionProfiler:
 
         def decorator(func):
 
+            def get_path(*args, **kwargs):
+                if path_callback is not None:
+                    return path_callback(func, *args, **kwargs)
+                return path or _get_object_name(func)
+
+            if inspect.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    _path = get_path(*args, **kwargs)
+
+                    self.begin()
+                    try:
+                        result = await func(*args, **kwargs)
+                    finally:
+                        self.commit()
+                        self._report(reporter, _path)
+                    return result
+
+                return async_wrapper
+
             @functools.wraps(func)
             def wrapper(*args, **kwargs):
-                if path_callback is not None:
-                    _path = path_callback(func, *args, **kwargs)
-                else:
-                    _path = path or _get_object_name(func)
+                _path = get_path(*args, **kwargs)
 
                 self.begin()
                 try:
                     result = func(*args, **kwargs)
                 finally:
                     self.commit()
-                    reporter.report(_path, self.stats)
+                    self._report(reporter, _path)
                 return result
 
             return wrapper
 
         return decorator
 
+    @staticmethod
+    def cache_info():
+        """Returns statistics of the statements classification cache,
+        which is shared by all profiling sessions.
+
+        :rtype: easy_profile.statements.CacheInfo
+
+        """
+        return statements.cache_info()
+
+    @staticmethod
+    def overhead_info():
+        """Returns overhead of all committed profiling sessions: time
+        spent by the cursor listeners, by computing statistics on commit
+        and by reporters of decorated functions and middlewares.
+
+        :rtype: OverheadInfo
+
+        """
+        with _overhead_lock:
+            return OverheadInfo(*_overhead)
+
     @property
     def stats(self):
         if self._stats is None:
@@ -127,9 +733,13 @@ class SessionProfiler:
             raise AssertionError("Profiling session has already begun")
 
         self.alive = True
-        self.queries = Queue()
+        self.queries = self._create_buffer()
         self._reset_stats()
 
+        if self.persistent:
+            _get_dispatcher(self.engine).attach(self)
+            return
+
         event.listen(self.engine, self._before, self._before_cursor_execute)
         event.listen(self.engine, self._after, self._after_cursor_execute)
 
@@ -143,44 +753,347 @@ class SessionProfiler:
             raise AssertionError("Profiling session is already committed")
 
         self.alive = False
-        self._get_stats()
 
-        event.remove(self.engine, self._before, self._before_cursor_execute)
-        event.remove(self.engine, self._after, self._after_cursor_execute)
+        if self.persistent:
+            _get_dispatcher(self.engine).detach(self)
+        else:
+            event.remove(
+                self.engine, self._before, self._before_cursor_execute
+            )
+            event.remove(
+                self.engine, self._after, self._after_cursor_execute
+            )
+
+        self._get_stats()
 
     def _get_stats(self):
-        """Calculate and returns session statistics."""
-        while not self.queries.empty():
-            query = self.queries.get()
-            self._stats["call_stack"].append(query)
-            match = OPERATOR_REGEX.match(query.statement)
-            if match:
-                self._stats[match.group(1).lower()] += 1
-                self._stats["total"] += 1
-                self._stats["duration"] += query.duration
-                duplicates = self._stats["duplicates"].get(query.statement, -1)
-                self._stats["duplicates"][query.statement] = duplicates + 1
+        """Returns session statistics.
+
+        Counters are aggregated when queries are captured, so only the
+        call stack is handed off and duplicates are computed lazily.
 
+        """
+        started = _timer()
+        # Hand off captured queries in bulk, queries of other threads may
+        # still be captured until the listeners are detached.
+        with self._lock:
+            queries, self.queries = self.queries, self._create_buffer()
+            fetches, self._fetches = self._fetches, []
+            table_fetches, self._table_fetches = self._table_fetches, []
+            slow_queries, self._slow_queries = self._slow_queries, []
+            listener_ns, self._listener_ns = self._listener_ns, 0
+        if self.max_queries is not None and self.sampling == "reservoir":
+            queries.sort(key=attrgetter("start_time"))
+        self._stats["call_stack"].extend(queries)
+        # Results are usually fetched by now, but fetching continues
+        # to update the records of queries.
+        for fetch in fetches:
+            self._stats["rows_fetched"] += fetch.rows
+            self._stats["fetch_duration_ns"] += fetch.duration_ns
+        for entries, fetch in table_fetches:
+            for entry in entries:
+                entry[2] += fetch.rows
+        self._stats["fetch_duration"] = (
+            self._stats["fetch_duration_ns"] / 1e9
+        )
+        self._stats["slow_queries"].extend(
+            self._get_slow_queries(slow_queries)
+        )
+        self._stats["duration"] = self._stats["duration_ns"] / 1e9
+
+        overhead = self._stats["overhead"]
+        overhead["listener_ns"] += listener_ns
+        overhead["stats_ns"] += _timer() - started
+        _add_overhead(1, self._stats["total"], listener_ns,
+                      overhead["stats_ns"])
+        self._stats.freeze()
         return self._stats
 
+    def _report(self, reporter, path):
+        """Reports statistics and records the time spent by reporter."""
+        started = _timer()
+        try:
+            reporter.report(path, self.stats)
+        finally:
+            self._add_report_time(_timer() - started)
+
+    def _add_report_time(self, duration_ns):
+        self.stats["overhead"]["report_ns"] += duration_ns
+        _add_overhead(report_ns=duration_ns)
+
+    def _get_slow_queries(self, slow_queries):
+        """Returns slow queries with cached execution plans, statements
+        without a cached plan are explained in the background.
+
+        """
+        for query, info, engine, parameters in slow_queries:
+            plan = None
+            if self.explainer is not None and info.kind in _EXPLAIN_KINDS:
+                plan = self.explainer.explain(
+                    engine, query.statement, parameters, info.fingerprint
+                )
+            yield SlowQuery(query, plan)
+
+    def _create_buffer(self):
+        if self.max_queries is not None and self.sampling == "ring":
+            return deque(maxlen=self.max_queries)
+        return []
+
     def _reset_stats(self):
-        self._stats = OrderedDict()
+        self._stats = Stats()
         self._stats["db"] = self.db_name
 
-        for operator in SQL_OPERATORS:
-            self._stats[operator] = 0
+        for kind in SQL_KINDS:
+            self._stats[kind] = 0
 
         self._stats["total"] = 0
         self._stats["duration"] = 0
+        self._stats["duration_ns"] = 0
+        self._stats["rows_affected"] = 0
+        self._stats["rows_fetched"] = 0
+        self._stats["fetch_duration"] = 0
+        self._stats["fetch_duration_ns"] = 0
+        self._fetches = []
         self._stats["call_stack"] = []
-        self._stats["duplicates"] = Counter()
+        self._stats["slow_queries"] = []
+        # Time spent by the profiler itself
+        self._stats["overhead"] = {
+            "listener_ns": 0,
+            "stats_ns": 0,
+            "report_ns": 0,
+        }
+        self._listener_ns = 0
+        self._slow_queries = []
+
+        # The first seen statement, number of executions and duration
+        # by fingerprint
+        self._statements = {}
+        self._stats.lazy(
+            "duplicates", functools.partial(_get_duplicates, self._statements)
+        )
+        self._stats.lazy(
+            "statements", functools.partial(_get_statements, self._statements)
+        )
+        self._stats.lazy(
+            "repeats", functools.partial(_get_repeats, self._statements)
+        )
+        self._stats.lazy(
+            "fanouts", functools.partial(_get_fanouts, self._statements)
+        )
+        # Number of executions and duration by call site
+        self._callsites = {}
+        self._stats.lazy(
+            "callsites", functools.partial(_get_callsites, self._callsites)
+        )
+        # Number of queries, duration and rows by table and ORM model
+        self._tables = {}
+        self._models = {}
+        self._table_fetches = []
+        self._stats.lazy(
+            "tables", functools.partial(_get_table_stats, self._tables)
+        )
+        self._stats.lazy(
+            "models", functools.partial(_get_table_stats, self._models)
+        )
 
     def _before_cursor_execute(self, conn, cursor, statement, parameters,
                                context, executemany):
-        context._query_start_time = _timer()
+        entered = _timer()
+        if not context.execution_options.get(IGNORE_OPTION):
+            start_time = context._query_start_time = _timer()
+            context._query_before_ns = start_time - entered
+            # Batches of executemany share the execution context
+            context._query_after_ns = 0
 
     def _after_cursor_execute(self, conn, cursor, statement, parameters,
                               context, executemany):
-        self.queries.put(DebugQuery(
-            statement, parameters, context._query_start_time, _timer()
+        entered = end_time = _timer()
+        start_time = getattr(context, "_query_start_time", None)
+        if start_time is None:
+            return
+        # Listeners of other sessions may have been called before
+        after_ns = getattr(context, "_query_after_ns", 0)
+        if self.subtract_overhead:
+            end_time = max(start_time, end_time - after_ns - _TIMER_COST_NS)
+        listener_ns = self._capture(conn, statement, parameters, context,
+                                    executemany, start_time, end_time,
+                                    entered)
+        context._query_after_ns = after_ns + listener_ns
+
+    def _capture(self, conn, statement, parameters, context, executemany,
+                 start_time, end_time, entered):
+        """Captures the query and updates statistics.
+
+        :return: time spent by the session listeners in ns
+
+        """
+        all_parameters = parameters
+        if self.max_parameters is not None:
+            parameters = self._limit_parameters(parameters, executemany)
+        # Equal statements share the string cached by the classifier
+        info = classify(statement)
+        callsite = _get_callsite() if self.callsites else None
+        rowcount = fetch = None
+        if self.fetches:
+            rowcount, fetch = self._watch_cursor(context)
+        tables = model = None
+        if self.table_stats:
+            tables = _get_tables(context, info)
+            model = _get_model(context)
+        query = DebugQuery(info.statement, parameters, start_time, end_time,
+                           callsite, rowcount, fetch)
+        # Sessions which aren't context local receive queries of all
+        # threads, statistics are updated by read-modify-write steps.
+        # Context local sessions receive queries of a single thread or
+        # task, so they append without locking.
+        # The cost of before listeners is counted by the first session
+        before_ns, context._query_before_ns = context._query_before_ns, 0
+        locked = not self.context_local
+        if locked:
+            self._lock.acquire()
+        try:
+            # The query may be executed while the session is committed
+            if self.alive:
+                self._add_query(query, info, all_parameters, executemany)
+                if self.table_stats:
+                    self._add_tables(query, tables, model)
+                if (self.slow_query_time is not None and
+                        query.duration >= self.slow_query_time):
+                    # Original parameters are kept to explain the statement
+                    self._slow_queries.append(
+                        (query, info, conn.engine, all_parameters)
+                    )
+            listener_ns = _timer() - entered
+            self._listener_ns += listener_ns + before_ns
+        finally:
+            if locked:
+                self._lock.release()
+        return listener_ns
+
+    def _add_tables(self, query, tables, model=None):
+        """Updates statistics of tables and the model of the query.
+
+        :param DebugQuery query: captured query
+        :param tuple tables: names of tables referenced by the query
+        :param str model: ORM model name of the query
+
+        """
+        rows = 0
+        if query.fetch is None and query.rowcount is not None:
+            rows = max(query.rowcount, 0)
+        entries = []
+        keys = [(self._tables, table) for table in tables]
+        if model is not None:
+            keys.append((self._models, model))
+        for aggregated, key in keys:
+            entry = aggregated.get(key)
+            if entry is None:
+                entry = aggregated[key] = [0, 0, 0]
+            entry[0] += 1
+            entry[1] += query.duration_ns
+            entry[2] += rows
+            entries.append(entry)
+        # Fetched rows are added on commit
+        if query.fetch is not None and entries:
+            self._table_fetches.append((entries, query.fetch))
+
+    @staticmethod
+    def _watch_cursor(context):
+        """Replaces cursor of the execution context with a proxy which
+        measures fetching, the proxy is shared by all sessions.
+
+        :return: cursor row count and fetch statistics
+
+        """
+        cursor = context.cursor
+        if isinstance(cursor, _FetchCursor):
+            return cursor.rowcount, cursor.fetch
+        if cursor.description is None:
+            return cursor.rowcount, None
+        fetch = FetchStats()
+        # The result of the execution is created with the context cursor
+        context.cursor = _FetchCursor(cursor, fetch)
+        return cursor.rowcount, fetch
+
+    def _limit_parameters(self, parameters, executemany):
+        if self.max_parameters == 0:
+            return None
+        if executemany and len(parameters) > self.max_parameters:
+            return parameters[:self.max_parameters]
+        return parameters
+
+    def _add_query(self, query, info=None, parameters=None,
+                   executemany=False):
+        """Captures query and updates aggregated statistics.
+
+        :param DebugQuery query: captured query
+        :param StatementInfo info: classification of the query statement
+        :param parameters: original parameters of the query, they may be
+            truncated in the captured query
+        :param bool executemany: is True for ``executemany`` queries
+
+        """
+        stats = self._stats
+        stats["total"] += 1
+        if (self.sampling == "reservoir" and
+                self.max_queries is not None and
+                len(self.queries) >= self.max_queries):
+            # Algorithm R, every query is retained with equal probability
+            index = random.randrange(stats["total"])
+            if index < self.max_queries:
+                self.queries[index] = query
+        else:
+            self.queries.append(query)
+
+        if info is None:
+            info = classify(query.statement)
+        stats[info.kind] += 1
+        stats["duration_ns"] += query.duration_ns
+        if query.fetch is not None:
+            self._fetches.append(query.fetch)
+        elif query.rowcount is not None and query.rowcount > 0:
+            stats["rows_affected"] += query.rowcount
+        if query.callsite is not None:
+            entry = self._callsites.get(query.callsite)
+            if entry is None:
+                self._callsites[query.callsite] = [1, query.duration_ns]
+            else:
+                entry[0] += 1
+                entry[1] += query.duration_ns
+        if info.kind == "transaction":
+            return
+        if parameters is None:
+            parameters = query.parameters
+        self._add_statement(query, info, _get_parameters_key(
+            query.statement, parameters, executemany
         ))
+
+    def _add_statement(self, query, info, parameters_key):
+        """Updates statistics of the statement fingerprint.
+
+        :param DebugQuery query: captured query
+        :param StatementInfo info: classification of the query statement
+        :param bytes parameters_key: digest of the statement with its
+            parameters (see ``_get_parameters_key``)
+
+        """
+        # Duplicates are grouped by fingerprint and keyed by the first
+        # statement seen with it.
+        entry = self._statements.get(info.fingerprint)
+        if entry is None:
+            keys = set() if parameters_key is None else {parameters_key}
+            self._statements[info.fingerprint] = [
+                query.statement, 1, query.duration_ns, 0, 0, 0, 0, keys
+            ]
+            return
+        entry[1] += 1
+        entry[2] += query.duration_ns
+        keys = entry[7]
+        if parameters_key is not None and parameters_key in keys:
+            entry[3] += 1
+            entry[4] += query.duration_ns
+        else:
+            entry[5] += 1
+            entry[6] += query.duration_ns
+            if parameters_key is not None and len(keys) < _MAX_PARAMETER_KEYS:
+                keys.add(parameters_key)
@@ -1,11 +1,19 @@
 from abc import ABC, abstractmethod
+import atexit
 from collections import OrderedDict
+import functools
+import logging
+import queue
 import sys
+import threading
+import weakref
 
 import sqlparse
 
 from .termcolors import colorize
 
+logger = logging.getLogger(__name__)
+
 
 def shorten(text, length, placeholder="..."):
     """Truncate the given text to fit in the given length.
@@ -22,6 +30,47 @@ def shorten(text, length, placeholder="..."):
     return text
 
 
+def format_duration(seconds):
+    """Formats duration in human readable units.
+
+    :param float seconds: duration in seconds
+
+    :return: formatted duration, e.g. ``"120µs"``, ``"4.2ms"`` or ``"1.50s"``
+
+    """
+    if seconds < 1e-3:
+        return "{0:.0f}µs".format(seconds * 1e6)
+    if seconds < 1:
+        return "{0:.1f}ms".format(seconds * 1e3)
+    return "{0:.2f}s".format(seconds)
+
+
+def _format_statement(statement):
+    return sqlparse.format(statement, reindent=True, keyword_case="upper")
+
+
+# Objects flushed when the interpreter exits, they are referenced weakly,
+# so objects which aren't closed can still be garbage collected.
+_flushed_at_exit = weakref.WeakSet()
+
+
+def flush_at_exit(obj):
+    """Registers the object whose ``flush`` is called when the
+    interpreter exits, unless it's garbage collected before.
+
+    """
+    _flushed_at_exit.add(obj)
+
+
+@atexit.register
+def _flush_all():
+    for obj in list(_flushed_at_exit):
+        try:
+            obj.flush()
+        except Exception:
+            logger.exception("Failed to flush %r at exit", obj)
+
+
 class Reporter(ABC):
     """Abstract class for profiler reporters."""
 
@@ -44,6 +93,16 @@ class StreamReporter(Reporter):
     :param file: output destination (stdout by default)
     :param bool colorized: set True if output should be colorized
     :param int display_duplicates: how much sql duplicates will be displayed
+    :param int format_cache_size: how much formatted sql statements will be
+        cached, ``0`` disables the cache
+    :param int max_format_length: sql statements longer than this are
+        displayed as is instead of pretty-printing (no limit by default)
+    :param int display_slow_queries: how much of the slowest queries will
+        be displayed with their execution plans
+    :param int display_callsites: how much call sites with the longest
+        queries duration will be displayed
+    :param int display_tables: how much tables and models with the longest
+        queries duration will be displayed
 
     """
 
@@ -53,6 +112,10 @@ class StreamReporter(Reporter):
         ("INSERT", "insert"),
         ("UPDATE", "update"),
         ("DELETE", "delete"),
+        ("CTE", "cte"),
+        ("DDL", "ddl"),
+        ("TCL", "transaction"),
+        ("Other", "other"),
         ("Totals", "total"),
         ("Duplicates", "duplicates_count"),
     ])
@@ -62,7 +125,12 @@ class StreamReporter(Reporter):
                  high=100,
                  file=sys.stdout,
                  colorized=True,
-                 display_duplicates=5):
+                 display_duplicates=5,
+                 format_cache_size=256,
+                 max_format_length=None,
+                 display_slow_queries=5,
+                 display_callsites=5,
+                 display_tables=5):
 
         if medium >= high:
             raise ValueError("Medium must be less than high")
@@ -72,19 +140,34 @@ class StreamReporter(Reporter):
         self._file = file
         self._colorized = colorized
         self._display_duplicates = display_duplicates or 0
+        self._max_format_length = max_format_length
+        self._display_slow_queries = display_slow_queries or 0
+        self._display_callsites = display_callsites or 0
+        self._display_tables = display_tables or 0
+        self._format_statement = functools.lru_cache(format_cache_size)(
+            _format_statement
+        )
 
     def report(self, path, stats):
         duplicates = stats["duplicates"]
         stats["duplicates_count"] = sum(duplicates.values())
         stats["db"] = shorten(stats["db"], 10)
 
-        output = self._colorize("\n{0}\n".format(path), ["bold"], fg="blue")
-        output += self.stats_table(stats)
+        # Parts of the report are joined once, so every report is
+        # written by a single write call.
+        output = [
+            self._colorize("\n{0}\n".format(path), ["bold"], fg="blue"),
+            self.stats_table(stats),
+        ]
 
         total = stats["total"]
-        duration = float(stats["duration"])
-        summary = "Total queries: {0} in {1:.3}s".format(total, duration)
-        output += self._info_line("\n{0}\n".format(summary), total)
+        duration = format_duration(stats["duration"])
+        summary = "Total queries: {0} in {1}".format(total, duration)
+        if stats.get("rows_fetched"):
+            summary += ", {0} rows fetched in {1}".format(
+                stats["rows_fetched"], format_duration(stats["fetch_duration"])
+            )
+        output.append(self._info_line("\n{0}\n".format(summary), total))
 
         # Display duplicated sql statements.
         #
@@ -92,17 +175,91 @@ class StreamReporter(Reporter):
         # a stream. It will be skipped if `display_duplicates` was
         # set to `0` or `None`.
         most_common = duplicates.most_common(self._display_duplicates)
+        statements = {}
+        if most_common and most_common[0][1] > 0:
+            statements = {
+                entry.statement: entry
+                for entry in (stats.get("statements") or {}).values()
+            }
         for statement, count in most_common:
             if count < 1:
                 continue
-            # Wrap SQL statement and returning a list of wrapped lines
-            statement = sqlparse.format(
-                statement, reindent=True, keyword_case="upper"
-            )
+            entry = statements.get(statement)
+            # Wrap SQL statement and returning a list of wrapped lines,
+            # formatted statements are cached as they recur across reports.
+            statement = self._format(statement)
             text = "\nRepeated {0} times:\n{1}\n".format(count + 1, statement)
-            output += self._info_line(text, count)
-
-        self._file.write(output)
+            if entry is not None:
+                text += self._format_repeats(entry)
+            output.append(self._info_line(text, count))
+
+        output.extend(self._format_slow_queries(stats))
+        output.extend(self._format_callsites(stats))
+        output.extend(self._format_tables(stats))
+
+        self._file.write("".join(output))
+
+    @staticmethod
+    def _format_repeats(entry):
+        return (
+            "{0} with equal parameters in {1}, "
+            "{2} with other parameters (N+1) in {3}\n".format(
+                entry.repeats,
+                format_duration(entry.repeats_duration_ns / 1e9),
+                entry.fanouts,
+                format_duration(entry.fanouts_duration_ns / 1e9),
+            )
+        )
+
+    def _format_slow_queries(self, stats):
+        slow_queries = sorted(
+            stats.get("slow_queries", ()),
+            key=lambda slow_query: slow_query.query.duration_ns,
+            reverse=True,
+        )
+        for query, plan in slow_queries[:self._display_slow_queries]:
+            text = "\nSlow query in {0}:\n{1}\n".format(
+                format_duration(query.duration), self._format(query.statement)
+            )
+            if plan:
+                text += "Plan:\n{0}\n".format(plan)
+            yield self._colorize(text, ["bold"], fg="red")
+
+    def _format_callsites(self, stats):
+        callsites = list((stats.get("callsites") or {}).items())
+        callsites = callsites[:self._display_callsites]
+        if callsites:
+            yield self._colorize("\nCall sites:\n", ["bold"])
+        for callsite, callsite_stats in callsites:
+            text = "{0} queries in {1} at {2}:{3} in {4}\n".format(
+                callsite_stats.count,
+                format_duration(callsite_stats.duration_ns / 1e9),
+                callsite.filename,
+                callsite.lineno,
+                callsite.function,
+            )
+            yield self._info_line(text, callsite_stats.count)
+
+    def _format_tables(self, stats):
+        for title, key in (("Tables", "tables"), ("Models", "models")):
+            tables = list((stats.get(key) or {}).items())
+            tables = tables[:self._display_tables]
+            if tables:
+                yield self._colorize("\n{0}:\n".format(title), ["bold"])
+            for name, table_stats in tables:
+                text = "{0}: {1} queries in {2}, {3} rows\n".format(
+                    name,
+                    table_stats.count,
+                    format_duration(table_stats.duration_ns / 1e9),
+                    table_stats.rows,
+                )
+                yield self._info_line(text, table_stats.count)
+
+    def _format(self, statement):
+        if (self._max_format_length is None or
+                len(statement) <= self._max_format_length):
+            return self._format_statement(statement)
+        return statement
 
     def stats_table(self, stats, sep="|"):
         """Formats profiling statistics as table.
@@ -119,10 +276,7 @@ class StreamReporter(Reporter):
         breakline = line.format(sep.join("-" * len(n) for n in h_names))
 
         # Creates table and writes a header
-        output = ""
-        output += breakline
-        output += line.format(sep.join(h_names))
-        output += breakline
+        output = [breakline, line.format(sep.join(h_names)), breakline]
 
         # Formats and writes row values in order by display_names.
         #
@@ -135,10 +289,10 @@ class StreamReporter(Reporter):
             values.append(str(value).center(size))
 
         row = line.format(sep.join(values))
-        output += self._info_line(row, stats["total"])
-        output += breakline
+        output.append(self._info_line(row, stats["total"]))
+        output.append(breakline)
 
-        return output
+        return "".join(output)
 
     def _info_line(self, line, total):
         """Returns colorized text according threshold.
@@ -159,3 +313,85 @@ class StreamReporter(Reporter):
         if not self._colorized:
             return text
         return colorize(text, opts, fg=fg, bg=bg)
+
+
+class QueuedReporter(Reporter):
+    """A reporter which hands statistics to a background worker thread,
+    so formatting and writing of reports are done off the request path.
+
+    The worker is started on the first report and remaining reports are
+    flushed when the reporter is closed or the interpreter exits.
+
+    :param Reporter reporter: reporter used by the worker
+    :param int maxsize: maximum number of reports waiting in the queue
+    :param bool block: set True if reporting should wait for a free slot
+        when the queue is full, otherwise the report is dropped
+    :param float timeout: maximum time to wait for a free slot in seconds,
+        the report is dropped after timeout (waits forever by default)
+
+    :attr int dropped: number of dropped reports
+
+    """
+
+    _stop = object()
+
+    def __init__(self, reporter, maxsize=1000, block=False, timeout=None):
+        if not isinstance(reporter, Reporter):
+            raise TypeError("reporter must be inherited from 'Reporter'")
+
+        self._reporter = reporter
+        self._queue = queue.Queue(maxsize)
+        self._block = block
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._worker = None
+        self.dropped = 0
+
+    def report(self, path, stats):
+        self._ensure_worker()
+        try:
+            self._queue.put(
+                (path, stats), block=self._block, timeout=self._timeout
+            )
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Blocks until all queued reports are written."""
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Flushes queued reports and stops the worker."""
+        with self._lock:
+            worker, self._worker = self._worker, None
+            if worker is None or not worker.is_alive():
+                return
+            atexit.unregister(self.close)
+            self._queue.put(self._stop)
+        worker.join()
+
+    def _ensure_worker(self):
+        # The worker isn't alive in a forked process either
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="easy-profile-reporter",
+                    daemon=True,
+                )
+                self._worker.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._stop:
+                    return
+                self._reporter.report(*item)
+            except Exception:
+                logger.exception("Failed to report profiling statistics")
+            finally:
+                self._queue.task_done()
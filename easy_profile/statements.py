@@ -0,0 +1,153 @@
+from collections import namedtuple, OrderedDict
+import functools
+import re
+
+# Maximum number of distinct statements with cached classification
+STATEMENT_CACHE_SIZE = 2048
+
+SQL_OPERATORS = ["select", "insert", "update", "delete"]
+# Kinds of statements which are counted in separate buckets
+SQL_KINDS = SQL_OPERATORS + ["cte", "ddl", "transaction", "other"]
+
+_KINDS = {
+    "select": "select",
+    "insert": "insert",
+    "update": "update",
+    "delete": "delete",
+    "with": "cte",
+    "create": "ddl",
+    "alter": "ddl",
+    "drop": "ddl",
+    "truncate": "ddl",
+    "rename": "ddl",
+    "comment": "ddl",
+    "begin": "transaction",
+    "start": "transaction",
+    "commit": "transaction",
+    "end": "transaction",
+    "rollback": "transaction",
+    "savepoint": "transaction",
+    "release": "transaction",
+}
+
+# String literals and comments are matched in one pass, so quotes in
+# comments and comment markers in strings are left alone
+_STRING_OR_COMMENT_REGEX = re.compile(
+    r"'(?:[^']|'')*'|/\*.*?\*/|--[^\n]*", re.DOTALL
+)
+# Bind parameters of the named, pyformat, format, qmark and numeric styles
+_PARAM_REGEX = re.compile(r"%\(\w+\)s|%s|(?<![:\w]):\w+|\$\d+")
+_NUMBER_REGEX = re.compile(r"(?<![\w.])[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b")
+_WHITESPACE_REGEX = re.compile(r"\s+")
+# Lists of placeholders, e.g. expanded IN parameters or VALUES rows
+_LIST_REGEX = re.compile(r"\( ?\?(?: ?, ?\?)* ?\)")
+_ROWS_REGEX = re.compile(r"\(\?\+\)(?: ?, ?\(\?\+\))+")
+# Leading keyword of a normalized statement, e.g. of "(select ...) union"
+_OPERATOR_REGEX = re.compile(r"[( ]*([a-z]+)")
+# Table name, possibly qualified by schema and quoted
+_NAME = r'(?:[\w$]+|"[^"]+"|`[^`]+`)(?:\.(?:[\w$]+|"[^"]+"|`[^`]+`))*'
+# Table names following keywords of a normalized statement, names of
+# a comma separated list may be followed by aliases
+_TABLE_REGEX = re.compile(
+    r"\b(from|join|update|into|table(?: if(?: not)? exists)?)"
+    r" (" + _NAME + r"(?:(?:(?: as)? [\w$]+)?, ?" + _NAME + r")*)(\()?"
+)
+_LIST_NAME_REGEX = re.compile(r"(?:^|,) ?(" + _NAME + r")")
+# Keywords which follow table keywords in place of a table name, e.g.
+# "for update nowait" or "on conflict (id) do update set"
+_NOT_TABLES = frozenset([
+    "as", "default", "do", "lateral", "nowait", "of", "on", "only", "select",
+    "set", "skip", "using", "values", "where", "with",
+])
+
+StatementInfo = namedtuple(
+    "StatementInfo", "statement,operator,kind,fingerprint,tables"
+)
+CacheInfo = namedtuple("CacheInfo", "hits,misses,maxsize,currsize,hit_rate")
+
+
+def _replace_string(match):
+    # Strings are placeholders, comments are whitespace
+    return "?" if match.group().startswith("'") else " "
+
+
+def fingerprint(statement):
+    """Normalizes SQL statement to a fingerprint which is the same for
+    statements that differ only by literals, parameters, length of
+    placeholders lists, comments, whitespace or case.
+
+    :param str statement: SQL statement
+
+    :return: normalized statement
+    :rtype: str
+
+    """
+    statement = _STRING_OR_COMMENT_REGEX.sub(_replace_string, statement)
+    statement = _PARAM_REGEX.sub("?", statement)
+    statement = _NUMBER_REGEX.sub("?", statement)
+    statement = _WHITESPACE_REGEX.sub(" ", statement).strip().lower()
+    statement = _LIST_REGEX.sub("(?+)", statement)
+    return _ROWS_REGEX.sub("(?+)", statement)
+
+
+def get_tables(normalized):
+    """Extracts names of referenced tables from normalized statement.
+
+    It's a fallback for statements which aren't compiled by sqlalchemy,
+    e.g. executed by ``exec_driver_sql``, keywords and functions in
+    place of tables are skipped.
+
+    :param str normalized: statement fingerprint
+
+    :return: unique table names in order of appearance
+    :rtype: tuple
+
+    """
+    tables = OrderedDict()
+    for keyword, names, call in _TABLE_REGEX.findall(normalized):
+        names = _LIST_NAME_REGEX.findall(names)
+        # Table valued functions, e.g. "from generate_series(?, ?)"
+        if call and keyword in ("from", "join"):
+            names.pop()
+        for name in names:
+            if name not in _NOT_TABLES:
+                tables[name.replace('"', "").replace("`", "")] = None
+    return tuple(tables)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def classify(statement):
+    """Classifies SQL statement. Results are cached per distinct statement
+    string, so classification of recurring statements is a cache hit and
+    the cached statement can be shared instead of equal copies.
+
+    Kind is one of ``SQL_KINDS``, statements with a leading keyword
+    which isn't DML, CTE, DDL or transaction control (e.g. ``CALL``,
+    ``COPY`` or ``PRAGMA``) are classified as ``"other"``.
+
+    :param str statement: SQL statement
+
+    :return: interned statement, leading keyword (``None`` if missing),
+        kind, fingerprint and tables
+    :rtype: StatementInfo
+
+    """
+    normalized = fingerprint(statement)
+    match = _OPERATOR_REGEX.match(normalized)
+    operator = match.group(1) if match else None
+    kind = _KINDS.get(operator, "other")
+    return StatementInfo(
+        statement, operator, kind, normalized, get_tables(normalized)
+    )
+
+
+def cache_info():
+    """Returns statistics of the statements classification cache.
+
+    :rtype: CacheInfo
+
+    """
+    info = classify.cache_info()
+    lookups = info.hits + info.misses
+    hit_rate = info.hits / lookups if lookups else 0.0
+    return CacheInfo(*info, hit_rate=hit_rate)
@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+
+from .reporters import flush_at_exit
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter:
+    """A thread safe file-like writer which accumulates written text and
+    writes it in batches, it can be passed as ``file`` to reporters.
+
+    Buffered text is written when it exceeds ``buffer_size`` characters,
+    by a timer thread at most ``flush_interval`` seconds after the last
+    flush, on ``flush`` and ``close``, and when the interpreter exits.
+    Every written text is kept whole, so concurrent reports never
+    interleave.
+
+    Text which failed to be written stays buffered up to ``max_retained``
+    characters, the oldest texts over the limit are dropped. Failures of
+    writes triggered by ``write`` are logged instead of being raised,
+    and while writing fails buffered text is retried only by the timer,
+    ``flush`` and ``close``.
+
+    Files opened by path are rotated when they exceed ``max_bytes``,
+    like :class:`logging.handlers.RotatingFileHandler`, the current file
+    is renamed to ``path.1``, the previous one to ``path.2`` and so on
+    up to ``backup_count``.
+
+    :param file: output destination, it's used instead of ``path``
+    :param str path: path of the file opened in append mode
+    :param int buffer_size: maximum number of buffered characters
+    :param float flush_interval: maximum seconds between flushes,
+        ``None`` disables flushing by time
+    :param int max_bytes: size of the file which triggers rotation,
+        ``0`` disables rotation
+    :param int backup_count: number of rotated files which are kept
+    :param str encoding: encoding of the file opened by path
+    :param int max_retained: maximum number of characters kept buffered
+        when writing fails
+
+    :attr int dropped: number of texts dropped after failed writes
+
+    """
+
+    def __init__(self,
+                 file=None,
+                 path=None,
+                 buffer_size=64 * 1024,
+                 flush_interval=1.0,
+                 max_bytes=0,
+                 backup_count=5,
+                 encoding="utf-8",
+                 max_retained=1024 * 1024):
+
+        if (file is None) == (path is None):
+            raise ValueError("Either file or path must be specified")
+        if max_bytes and path is None:
+            raise ValueError("Only files opened by path can be rotated")
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.encoding = encoding
+        self.max_retained = max_retained
+        self.dropped = 0
+
+        self._file = file
+        self._buffer = []
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._failing = False
+        self._closed = False
+        if path is not None:
+            self._file = self._open()
+        flush_at_exit(self)
+
+    def write(self, text):
+        with self._lock:
+            if self._closed:
+                raise ValueError("Write to closed writer")
+            self._buffer.append(text)
+            self._buffered += len(text)
+            if ((self._buffered >= self.buffer_size and
+                 not self._failing) or
+                    (self.flush_interval is not None and
+                     time.monotonic() - self._last_flush >=
+                     self.flush_interval)):
+                self._try_flush()
+            elif self._failing:
+                self._retain()
+            elif self.flush_interval is not None and self._timer is None:
+                self._schedule()
+        return len(text)
+
+    def flush(self):
+        """Writes buffered text to the file."""
+        with self._lock:
+            if not self._closed:
+                self._flush()
+
+    def close(self):
+        """Flushes buffered text and closes the file opened by path."""
+        with self._lock:
+            if self._closed:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._flush()
+            self._closed = True
+            if self.path is not None:
+                self._file.close()
+
+    def _schedule(self):
+        delay = self.flush_interval - (time.monotonic() - self._last_flush)
+        # The timer keeps the writer alive until buffered text is written
+        self._timer = threading.Timer(max(delay, 0), self._flush_by_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_by_timer(self):
+        with self._lock:
+            self._timer = None
+            if not self._closed:
+                self._try_flush()
+
+    def _try_flush(self):
+        try:
+            self._flush()
+        except Exception:
+            # A full disk fails every write, it's logged once
+            if not self._failing:
+                logger.exception("Failed to write buffered text")
+            self._failing = True
+            if self.flush_interval is not None and self._timer is None:
+                self._schedule()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        try:
+            self._file.write(text)
+        except Exception:
+            self._retain()
+            raise
+        # Buffered text is dropped only once it's written
+        self._buffer, self._buffered = [], 0
+        self._failing = False
+        self._file.flush()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _retain(self):
+        """Drops the oldest texts over ``max_retained`` characters."""
+        index = 0
+        while (self._buffered > self.max_retained and
+               index < len(self._buffer)):
+            self._buffered -= len(self._buffer[index])
+            index += 1
+        if index:
+            del self._buffer[:index]
+            self.dropped += index
+
+    def _open(self):
+        return open(self.path, "a", encoding=self.encoding)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = "{0}.{1}".format(self.path, index)
+                if os.path.exists(source):
+                    os.replace(
+                        source, "{0}.{1}".format(self.path, index + 1)
+                    )
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._file = self._open()
@@ -49,6 +49,6 @@ setuptools.setup(
     ],
     keywords=["sqlalchemy", "easy", "profile", "profiler", "profiling"],
     install_requires=["sqlalchemy<2.1", "sqlparse>=0.3.0"],
-    tests_require=["coverage"],
+    tests_require=["coverage", "aiosqlite"],
     extras_require={"dev": ["tox"]}
 )
@@ -0,0 +1,164 @@
+import io
+import unittest
+from unittest import mock
+
+from easy_profile import reporters
+from easy_profile.aggregation import (
+    AggregateReporter,
+    COUNT_BOUNDS,
+    Histogram,
+)
+from easy_profile.profiler import StatementStats
+
+
+def make_stats(total, duration, statements=()):
+    return {
+        "total": total,
+        "duration": duration,
+        "statements": {
+            statement.lower(): StatementStats(statement, count, duration_ns)
+            for statement, count, duration_ns in statements
+        },
+    }
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_add(self):
+        histogram = Histogram(COUNT_BOUNDS)
+        for value in (0, 1, 3, 5000, 100000):
+            histogram.add(value)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 105004)
+        self.assertEqual(histogram.max, 100000)
+        self.assertEqual(histogram.counts[0], 2)
+        self.assertEqual(histogram.counts[2], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(len(histogram.counts), len(COUNT_BOUNDS) + 1)
+
+    def test_percentile(self):
+        histogram = Histogram(COUNT_BOUNDS)
+        self.assertEqual(histogram.percentile(50), 0)
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 64)
+        self.assertEqual(histogram.percentile(95), 100)
+        self.assertEqual(histogram.percentile(0), 1)
+
+        histogram.add(10 ** 6)
+        self.assertEqual(histogram.percentile(100), 10 ** 6)
+
+
+class TestAggregateReporter(unittest.TestCase):
+
+    def test_summary(self):
+        reporter = AggregateReporter(flush_interval=None, top=1)
+        reporter.report("GET /users", make_stats(10, 0.1, [
+            ("SELECT id FROM users WHERE id = 1", 9, 90000000),
+            ("SELECT id FROM roles", 1, 1000),
+        ]))
+        reporter.report("GET /users", make_stats(20, 0.3, [
+            ("SELECT id FROM users WHERE id = 1", 20, 300000000),
+        ]))
+        reporter.report("GET /roles", make_stats(1, 0.001))
+
+        summary = reporter.summary()
+        self.assertEqual(list(summary["paths"]), ["GET /users", "GET /roles"])
+        users = summary["paths"]["GET /users"]
+        self.assertEqual(users["requests"], 2)
+        self.assertEqual(users["queries"]["count"], 2)
+        self.assertEqual(users["queries"]["sum"], 30)
+        self.assertEqual(users["queries"]["p50"], 16)
+        self.assertEqual(users["queries"]["p99"], 20)
+        self.assertAlmostEqual(users["duration"]["sum"], 0.4)
+        self.assertEqual(summary["statements"], [{
+            "statement": "SELECT id FROM users WHERE id = 1",
+            "count": 29,
+            "duration": 0.39,
+            "error": 0.0,
+        }])
+
+    def test_max_paths(self):
+        reporter = AggregateReporter(flush_interval=None, max_paths=1)
+        for path in ("/a", "/b", "/c", "/a"):
+            reporter.report(path, make_stats(1, 0.1))
+        paths = reporter.summary()["paths"]
+        self.assertEqual(paths["/a"]["requests"], 2)
+        self.assertEqual(paths[reporter.other_path]["requests"], 2)
+
+    def test_max_statements(self):
+        reporter = AggregateReporter(flush_interval=None, max_statements=2)
+        reporter.report("/", make_stats(3, 0.1, [
+            ("SELECT 1", 1, 300),
+            ("SELECT 2", 1, 100),
+        ]))
+        reporter.report("/", make_stats(1, 0.1, [("SELECT 3", 1, 200)]))
+        statements = reporter.summary()["statements"]
+        self.assertEqual(
+            [entry["statement"] for entry in statements],
+            ["SELECT 1", "SELECT 3"],
+        )
+        # The new statement inherits the duration of the evicted one
+        self.assertEqual(statements[1]["duration"], 300 / 1e9)
+        self.assertEqual(statements[1]["error"], 100 / 1e9)
+        self.assertEqual(statements[1]["count"], 1)
+
+    def test_max_statements_new_hot_statement(self):
+        reporter = AggregateReporter(flush_interval=None, max_statements=2,
+                                     top=1)
+        reporter.report("/", make_stats(2, 0.1, [
+            ("SELECT 1", 1, 1000),
+            ("SELECT 2", 1, 10),
+        ]))
+        # A hot statement isn't reset by evicting itself over and over
+        for _ in range(200):
+            reporter.report("/", make_stats(2, 0.1, [
+                ("SELECT 3", 1, 10),
+                ("SELECT 4", 1, 10),
+            ]))
+        top, = reporter.summary()["statements"]
+        self.assertIn(top["statement"], ("SELECT 3", "SELECT 4"))
+        self.assertGreater(top["duration"], 1000 / 1e9)
+
+    def test_flush(self):
+        on_flush = mock.Mock()
+        reporter = AggregateReporter(flush_interval=None, on_flush=on_flush)
+        reporter.report("/", make_stats(1, 0.1))
+        reporter.flush()
+        summary = on_flush.call_args[0][0]
+        self.assertEqual(summary["paths"]["/"]["requests"], 1)
+        self.assertEqual(reporter.summary()["paths"], {})
+
+    def test_flush_at_exit(self):
+        on_flush = mock.Mock()
+        reporter = AggregateReporter(on_flush=on_flush)
+        reporter.report("/", make_stats(1, 0.1))
+        reporters._flush_all()
+        summary = on_flush.call_args[0][0]
+        self.assertEqual(summary["paths"]["/"]["requests"], 1)
+
+    def test_flush_interval(self):
+        on_flush = mock.Mock()
+        reporter = AggregateReporter(flush_interval=60, on_flush=on_flush)
+        reporter._started = 1000.0
+        with mock.patch("easy_profile.aggregation.time") as mocked:
+            mocked.monotonic.return_value = reporter._started + 30
+            reporter.report("/", make_stats(1, 0.1))
+            on_flush.assert_not_called()
+            mocked.monotonic.return_value = reporter._started + 60
+            reporter.report("/", make_stats(1, 0.1))
+            on_flush.assert_called_once()
+
+    def test_flush_to_file(self):
+        output = io.StringIO()
+        reporter = AggregateReporter(flush_interval=None, file=output)
+        reporter.flush()
+        self.assertEqual(output.getvalue(), "")
+        reporter.report("GET /users", make_stats(2, 0.002, [
+            ("SELECT id FROM users", 2, 2000000),
+        ]))
+        reporter.flush()
+        text = output.getvalue()
+        self.assertIn("GET /users: 1 requests, queries p50/p95/p99 2/2/2, "
+                      "duration p50/p95/p99 2.0ms/2.0ms/2.0ms", text)
+        self.assertIn("2 times in 2.0ms: SELECT id FROM users", text)
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import text
+
+from easy_profile.explain import default_explainer, Explainer, is_explainable
+
+
+class TestExplainer(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "test.db")
+        self.engine = create_engine("sqlite:///" + path)
+        self.addCleanup(self.engine.dispose)
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TABLE users (id int)"))
+
+    def test_default_explainer(self):
+        self.assertIsInstance(default_explainer, Explainer)
+
+    def test_is_explainable(self):
+        self.assertTrue(is_explainable(self.engine))
+        self.assertFalse(is_explainable(create_engine("sqlite://")))
+        self.assertFalse(is_explainable(
+            create_engine("sqlite:///test", poolclass=StaticPool)
+        ))
+        async_engine = create_async_engine("sqlite+aiosqlite:///test")
+        self.assertFalse(is_explainable(async_engine.sync_engine))
+
+    def test_explain(self):
+        explainer = Explainer()
+        args = (self.engine, "SELECT id FROM users WHERE id = ?", (1,), "fp")
+        # The plan is captured in the background
+        self.assertIsNone(explainer.explain(*args))
+        explainer.join()
+        self.assertIn("SCAN users", explainer.explain(*args))
+
+    def test_explain_cached_by_fingerprint(self):
+        explainer = Explainer(min_interval=0)
+        with mock.patch.object(explainer, "_explain",
+                               return_value="plan") as mocked:
+            explainer.explain(self.engine, "SELECT 1", (), "fp")
+            explainer.join()
+            for _ in range(3):
+                self.assertEqual(
+                    explainer.explain(self.engine, "SELECT 1", (), "fp"),
+                    "plan",
+                )
+            mocked.assert_called_once()
+
+    def test_explain_rate_limited(self):
+        explainer = Explainer(min_interval=60)
+        with mock.patch.object(explainer, "_explain",
+                               return_value="plan") as mocked:
+            explainer.explain(self.engine, "SELECT 1", (), "a")
+            explainer.join()
+            explainer.explain(self.engine, "SELECT 2", (), "b")
+            explainer.join()
+            mocked.assert_called_once()
+            # Cached plans aren't rate limited
+            self.assertEqual(
+                explainer.explain(self.engine, "SELECT 1", (), "a"), "plan"
+            )
+            explainer.clear()
+            explainer.explain(self.engine, "SELECT 2", (), "b")
+            explainer.join()
+            self.assertEqual(
+                explainer.explain(self.engine, "SELECT 2", (), "b"), "plan"
+            )
+
+    def test_explain_max_plans(self):
+        explainer = Explainer(max_plans=1, min_interval=0)
+        with mock.patch.object(explainer, "_explain",
+                               return_value="plan") as mocked:
+            for fingerprint in ("a", "b", "a"):
+                explainer.explain(self.engine, "SELECT 1", (), fingerprint)
+                explainer.join()
+            self.assertEqual(mocked.call_count, 3)
+
+    def test_explain_max_pending(self):
+        explainer = Explainer(min_interval=0, max_pending=1)
+        with mock.patch.object(explainer, "_ensure_worker"):
+            explainer.explain(self.engine, "SELECT 1", (), "a")
+            explainer.explain(self.engine, "SELECT 2", (), "b")
+        self.assertEqual(explainer._queue.qsize(), 1)
+        self.assertEqual(explainer._pending, {(self.engine, "a")})
+
+    def test_explain_statement_error(self):
+        explainer = Explainer(min_interval=0)
+        error = exc.ProgrammingError("EXPLAIN", (), Exception())
+        with mock.patch.object(explainer, "_explain",
+                               side_effect=error) as mocked:
+            for _ in range(2):
+                self.assertIsNone(
+                    explainer.explain(self.engine, "SELECT 1", (), "fp")
+                )
+                explainer.join()
+            # Statements which can't be explained are cached
+            mocked.assert_called_once()
+
+    def test_explain_environment_error(self):
+        explainer = Explainer(min_interval=0)
+        with mock.patch.object(explainer, "_explain",
+                               side_effect=exc.TimeoutError()) as mocked:
+            for _ in range(2):
+                self.assertIsNone(
+                    explainer.explain(self.engine, "SELECT 1", (), "fp")
+                )
+                explainer.join()
+            self.assertEqual(mocked.call_count, 2)
+
+    def test_explain_error(self):
+        explainer = Explainer(min_interval=0)
+        explainer.explain(self.engine, "SELECT * FROM nope", (), "fp")
+        explainer.join()
+        self.assertIsNone(
+            explainer.explain(self.engine, "SELECT * FROM nope", (), "fp")
+        )
+        explainer.join()
+
+    def test_explain_shared_connection(self):
+        engine = create_engine("sqlite://")
+        explainer = Explainer(min_interval=0)
+        with engine.connect() as conn:
+            # Legacy connections of SQLAlchemy 1.4 don't autobegin
+            conn.begin()
+            conn.execute(text("CREATE TABLE users (id int)"))
+            conn.execute(text("INSERT INTO users VALUES (1)"))
+            with mock.patch.object(explainer, "_explain") as mocked:
+                self.assertIsNone(
+                    explainer.explain(engine, "SELECT 1", (), "fp")
+                )
+            explainer.join()
+            mocked.assert_not_called()
+            # The transaction of the application isn't rolled back
+            self.assertTrue(conn.in_transaction())
+            count = conn.execute(text("SELECT count(*) FROM users"))
+            self.assertEqual(count.scalar(), 1)
@@ -0,0 +1,188 @@
+import gc
+import io
+import json
+import socket
+import unittest
+from unittest import mock
+import weakref
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+from easy_profile import reporters
+from easy_profile.exporters import (
+    JSONLinesReporter,
+    OpenMetricsReporter,
+    SpanReporter,
+)
+from easy_profile.profiler import SessionProfiler
+
+
+def profile(*statements):
+    engine = create_engine("sqlite://")
+    profiler = SessionProfiler(engine)
+    with profiler:
+        with engine.connect() as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+    return profiler.stats
+
+
+class TestJSONLinesReporter(unittest.TestCase):
+
+    def test_report(self):
+        stats = profile("SELECT 1", "SELECT 1", "SELECT 2")
+        dest = io.StringIO()
+        JSONLinesReporter(file=dest).report("GET /users", stats)
+        record = json.loads(dest.getvalue())
+        self.assertEqual(record["path"], "GET /users")
+        self.assertEqual(record["db"], "undefined")
+        self.assertEqual(record["select"], 3)
+        self.assertEqual(record["total"], 3)
+        # Statements are grouped by fingerprint
+        self.assertEqual(record["duplicates"], 2)
+        # Equal statements are repeats, other literals are fanouts
+        self.assertEqual(record["repeats"], 1)
+        self.assertEqual(record["fanouts"], 1)
+        self.assertEqual(record["slow_queries"], [])
+        self.assertNotIn("statements", record)
+        self.assertTrue(dest.getvalue().endswith("}\n"))
+
+    def test_report_statements(self):
+        stats = profile("SELECT 1", "SELECT 1")
+        dest = io.StringIO()
+        reporter = JSONLinesReporter(file=dest, include_statements=True)
+        reporter.report("GET /users", stats)
+        statement, = json.loads(dest.getvalue())["statements"]
+        self.assertEqual(statement["statement"], "SELECT 1")
+        self.assertEqual(statement["count"], 2)
+
+    def test_report_batch(self):
+        dest = mock.Mock()
+        reporter = JSONLinesReporter(file=dest, batch_size=2)
+        stats = profile("SELECT 1")
+        reporter.report("a", stats)
+        dest.write.assert_not_called()
+        reporter.report("b", stats)
+        dest.write.assert_called_once()
+        self.assertEqual(dest.write.call_args[0][0].count("\n"), 2)
+        reporter.report("c", stats)
+        reporter.flush()
+        self.assertEqual(dest.write.call_count, 2)
+        reporter.flush()
+        self.assertEqual(dest.write.call_count, 2)
+
+    def test_report_batch_at_exit(self):
+        dest = io.StringIO()
+        reporter = JSONLinesReporter(file=dest, batch_size=2)
+        reporter.report("a", profile("SELECT 1"))
+        self.assertEqual(dest.getvalue(), "")
+        reporters._flush_all()
+        self.assertEqual(json.loads(dest.getvalue())["path"], "a")
+        # Reporters aren't kept alive by the exit hook
+        ref = weakref.ref(reporter)
+        del reporter
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class TestOpenMetricsReporter(unittest.TestCase):
+
+    def test_expose(self):
+        reporter = OpenMetricsReporter()
+        stats = profile("SELECT 1", "SELECT 1", "CREATE TABLE users (id int)")
+        reporter.report('GET "/users"', stats)
+        reporter.report('GET "/users"', stats)
+        output = reporter.expose()
+        label = 'path="GET \\"/users\\""'
+        self.assertIn(
+            "easy_profile_requests_total{%s} 2\n" % label, output
+        )
+        self.assertIn(
+            'easy_profile_queries_total{%s,kind="select"} 4\n' % label, output
+        )
+        self.assertIn(
+            "easy_profile_duplicate_queries_total{%s} 2\n" % label, output
+        )
+        self.assertIn(
+            'easy_profile_request_queries_bucket{%s,le="2.0"} 0\n' % label,
+            output,
+        )
+        self.assertIn(
+            'easy_profile_request_queries_bucket{%s,le="4.0"} 2\n' % label,
+            output,
+        )
+        self.assertIn(
+            "easy_profile_request_queries_sum{%s} 6\n" % label, output
+        )
+        self.assertIn(
+            "easy_profile_request_query_duration_seconds_count{%s} 2\n"
+            % label,
+            output,
+        )
+        self.assertTrue(output.endswith("# EOF\n"))
+
+    def test_max_paths(self):
+        reporter = OpenMetricsReporter(prefix="app", max_paths=1)
+        stats = profile("SELECT 1")
+        reporter.report("a", stats)
+        reporter.report("b", stats)
+        output = reporter.expose()
+        self.assertIn('app_requests_total{path="a"} 1\n', output)
+        self.assertIn('app_requests_total{path="<other>"} 1\n', output)
+
+
+class TestSpanReporter(unittest.TestCase):
+
+    def test_initialization_error(self):
+        with self.assertRaises(ValueError):
+            SpanReporter()
+        with self.assertRaises(ValueError):
+            SpanReporter(file=io.StringIO(), address=("127.0.0.1", 4317))
+
+    def test_report_file(self):
+        dest = io.StringIO()
+        reporter = SpanReporter(file=dest, service_name="app")
+        stats = profile("SELECT 1", "CREATE TABLE users (id int)")
+        reporter.report("GET /users", stats)
+        root, select, create = map(json.loads, dest.getvalue().splitlines())
+        self.assertEqual(root["name"], "GET /users")
+        self.assertEqual(root["attributes"]["service.name"], "app")
+        self.assertEqual(root["attributes"]["db.queries"], 2)
+        self.assertEqual(select["name"], "select")
+        self.assertEqual(create["name"], "ddl")
+        self.assertEqual(select["attributes"]["db.statement"], "SELECT 1")
+        self.assertNotIn("db.parameters", select["attributes"])
+        for span in (select, create):
+            self.assertEqual(span["traceId"], root["traceId"])
+            self.assertEqual(span["parentSpanId"], root["spanId"])
+        self.assertEqual(
+            root["startTimeUnixNano"], select["startTimeUnixNano"]
+        )
+        self.assertEqual(root["endTimeUnixNano"], create["endTimeUnixNano"])
+        query = stats["call_stack"][0]
+        self.assertEqual(
+            select["endTimeUnixNano"] - select["startTimeUnixNano"],
+            query.duration_ns,
+        )
+
+    def test_report_empty(self):
+        dest = io.StringIO()
+        SpanReporter(file=dest).report("GET /", profile())
+        self.assertEqual(dest.getvalue(), "")
+
+    def test_report_udp(self):
+        collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        collector.bind(("127.0.0.1", 0))
+        collector.settimeout(5)
+        self.addCleanup(collector.close)
+        reporter = SpanReporter(
+            address=collector.getsockname(), include_parameters=True
+        )
+        self.addCleanup(reporter.close)
+        reporter.report("GET /users", profile("SELECT 1"))
+        root = json.loads(collector.recv(65536))
+        span = json.loads(collector.recv(65536))
+        self.assertEqual(root["name"], "GET /users")
+        self.assertEqual(span["attributes"]["db.parameters"], [])
+        self.assertEqual(reporter.dropped, 0)
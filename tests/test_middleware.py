@@ -1,13 +1,47 @@
+import asyncio
 from queue import Queue
 from threading import Thread
 from time import sleep
 import unittest
 from unittest import mock
 
-from easy_profile.middleware import EasyProfileMiddleware
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.sql import text
+
+from easy_profile.middleware import (
+    _compile_patterns,
+    EasyProfileASGIMiddleware,
+    EasyProfileMiddleware,
+)
 from easy_profile.reporters import Reporter, StreamReporter
 
 
+class TestCompilePatterns(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertFalse(_compile_patterns([])("/about"))
+
+    def test_combined(self):
+        match = _compile_patterns([r"^/static/", r"/health$", r"(a|b)+c"])
+        self.assertTrue(match("/static/app.js"))
+        self.assertTrue(match("/health"))
+        self.assertTrue(match("abc"))
+        self.assertFalse(match("/api/health/check"))
+
+    def test_group_references(self):
+        match = _compile_patterns([r"^/(v\d)/", r"^/(\w+)/\1$"])
+        self.assertTrue(match("/v1/users"))
+        self.assertTrue(match("/api/api"))
+        self.assertFalse(match("/api/users"))
+
+    def test_global_flags(self):
+        match = _compile_patterns([r"^/about", r"(?i)^/health"])
+        self.assertTrue(match("/HEALTH"))
+        self.assertTrue(match("/about"))
+        self.assertFalse(match("/ABOUT"))
+
+
 class TestEasyProfileMiddleware(unittest.TestCase):
 
     def test_initialization_default(self):
@@ -19,6 +53,9 @@ class TestEasyProfileMiddleware(unittest.TestCase):
         self.assertEqual(mw.exclude_path, [])
         self.assertEqual(mw.min_time, 0)
         self.assertEqual(mw.min_query_count, 1)
+        self.assertFalse(mw.persistent)
+        self.assertFalse(mw.context_local)
+        self.assertEqual(mw.profiler_options, {})
 
     def test_initialize_custom(self):
         mocked_app = mock.Mock()
@@ -30,12 +67,16 @@ class TestEasyProfileMiddleware(unittest.TestCase):
             exclude_path=expected_exclude_path,
             min_time=42,
             min_query_count=42,
+            persistent=True,
+            context_local=True,
         )
         self.assertEqual(mw.app, mocked_app)
         self.assertEqual(mw.reporter, mocked_reporter)
         self.assertEqual(mw.exclude_path, expected_exclude_path)
         self.assertEqual(mw.min_time, 42)
         self.assertEqual(mw.min_query_count, 42)
+        self.assertTrue(mw.persistent)
+        self.assertTrue(mw.context_local)
 
     def test_initialize_reporter_type_error(self):
         with self.assertRaises(TypeError) as exec_info:
@@ -45,6 +86,16 @@ class TestEasyProfileMiddleware(unittest.TestCase):
             "reporter must be inherited from 'Reporter'"
         )
 
+    def test__create_profiler(self):
+        mw = EasyProfileMiddleware(
+            mock.Mock(),
+            persistent=True,
+            profiler_options={"max_queries": 10},
+        )
+        profiler = mw._create_profiler()
+        self.assertTrue(profiler.persistent)
+        self.assertEqual(profiler.max_queries, 10)
+
     def test__report_stats(self):
         mocked_reporter = mock.Mock(spec=Reporter)
         mw = EasyProfileMiddleware(
@@ -73,6 +124,104 @@ class TestEasyProfileMiddleware(unittest.TestCase):
         for path in ["/faq", "/about", "/search"]:
             self.assertFalse(mw._ignore_request(path))
 
+    def test__ignore_request_cache(self):
+        mw = EasyProfileMiddleware(
+            mock.Mock(), exclude_path=[r"^/health"], exclude_cache_size=2
+        )
+        self.assertTrue(mw._ignore_request("/health"))
+        self.assertTrue(mw._ignore_request("/health"))
+        self.assertFalse(mw._ignore_request("/about"))
+        info = mw._match_exclude_path.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+        # Assigned patterns are recompiled and the cache is reset
+        mw.exclude_path = [r"^/about"]
+        self.assertFalse(mw._ignore_request("/health"))
+        self.assertTrue(mw._ignore_request("/about"))
+
+        mw = EasyProfileMiddleware(
+            mock.Mock(), exclude_path=[r"^/health"], exclude_cache_size=0
+        )
+        self.assertTrue(mw._ignore_request("/health"))
+        self.assertFalse(hasattr(mw._match_exclude_path, "cache_info"))
+
+    def test_initialize_sample_rate_value_error(self):
+        with self.assertRaises(ValueError):
+            EasyProfileMiddleware(mock.Mock(), sample_rate=1.5)
+        with self.assertRaises(ValueError):
+            EasyProfileMiddleware(
+                mock.Mock(), path_sample_rates={r"^/api": -0.1}
+            )
+
+    def test__sample(self):
+        mw = EasyProfileMiddleware(
+            mock.Mock(),
+            sample_rate=0,
+            path_sample_rates={r"^/api/users": 1, r"^/api": 0.5},
+        )
+        self.assertFalse(mw._sample("/about"))
+        self.assertTrue(mw._sample("/about", forced=True))
+        self.assertTrue(mw._sample("/api/users"))
+        with mock.patch("random.random", return_value=0.4):
+            self.assertTrue(mw._sample("/api/roles"))
+        with mock.patch("random.random", return_value=0.6):
+            self.assertFalse(mw._sample("/api/roles"))
+
+    def test__sample_with_overhead_budget(self):
+        mw = EasyProfileMiddleware(mock.Mock(), overhead_budget=0.05)
+        self.assertEqual(mw.adaptive_rate, 1.0)
+        for _ in range(100):
+            mw._update_overhead(overhead=20, elapsed=100)
+        self.assertAlmostEqual(mw.adaptive_rate, 0.25, places=3)
+        with mock.patch("random.random", return_value=0.3):
+            self.assertFalse(mw._sample("/about"))
+            self.assertTrue(mw._sample("/about", forced=True))
+        for _ in range(100):
+            mw._update_overhead(overhead=1, elapsed=100)
+        self.assertEqual(mw.adaptive_rate, 1.0)
+
+    def test__call__with_force_header(self):
+        app = mock.Mock(return_value=[b"OK"])
+        mw = EasyProfileMiddleware(
+            app,
+            reporter=mock.Mock(spec=Reporter),
+            sample_rate=0,
+            force_header="X-Profile",
+        )
+        with mock.patch.object(mw, "_report_stats") as mocked_report_stats:
+            mw(dict(PATH_INFO="/about"), None)
+            mocked_report_stats.assert_not_called()
+            mw(dict(PATH_INFO="/about", HTTP_X_PROFILE="1"), None)
+            mocked_report_stats.assert_called_once()
+        self.assertEqual(app.call_count, 2)
+
+    def test__call__measures_overhead(self):
+        mw = EasyProfileMiddleware(
+            mock.Mock(return_value=[b"OK"]),
+            reporter=mock.Mock(spec=Reporter),
+            overhead_budget=0.5,
+        )
+        with mock.patch.object(mw, "_update_overhead") as mocked_update:
+            mw(dict(PATH_INFO="/about"), None)
+            mocked_update.assert_called_once()
+            overhead, elapsed = mocked_update.call_args[0]
+            self.assertGreater(overhead, 0)
+            self.assertGreaterEqual(elapsed, overhead)
+
+    def test__call__records_report_overhead(self):
+        engine = create_engine("sqlite://")
+
+        def app(environ, start_response):
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return [b"OK"]
+
+        reporter = mock.Mock(spec=Reporter)
+        mw = EasyProfileMiddleware(app, engine, reporter=reporter)
+        mw(dict(PATH_INFO="/about"), None)
+        overhead = reporter.report.call_args[0][1]["overhead"]
+        self.assertGreater(overhead["listener_ns"], 0)
+        self.assertGreater(overhead["report_ns"], 0)
+
     def test__call__for_available_path(self):
         mw = EasyProfileMiddleware(
             mock.Mock(),
@@ -81,11 +230,44 @@ class TestEasyProfileMiddleware(unittest.TestCase):
         )
         with mock.patch.object(mw, "_report_stats") as mocked_report_stats:
             environ = dict(PATH_INFO="/api/roles", REQUEST_METHOD="GET")
-            mw(environ, None)
+            mw(environ, None).close()
             mocked_report_stats.assert_called()
             expected = environ["REQUEST_METHOD"] + " " + environ["PATH_INFO"]
             self.assertEqual(mocked_report_stats.call_args[0][0], expected)
 
+    def test__call__for_list_response(self):
+        expected_response = [b"OK"]
+        mw = EasyProfileMiddleware(
+            mock.Mock(return_value=expected_response),
+            reporter=mock.Mock(spec=Reporter),
+        )
+        with mock.patch.object(mw, "_report_stats") as mocked_report_stats:
+            environ = dict(PATH_INFO="/api/roles", REQUEST_METHOD="GET")
+            self.assertIs(mw(environ, None), expected_response)
+            mocked_report_stats.assert_called()
+
+    def test__call__for_streamed_response(self):
+        engine = create_engine("sqlite://")
+
+        def app(environ, start_response):
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                yield b"first"
+                conn.execute(text("SELECT 2"))
+                yield b"second"
+
+        reporter = mock.Mock(spec=Reporter)
+        mw = EasyProfileMiddleware(app, engine, reporter=reporter)
+        response = mw(dict(PATH_INFO="/export"), None)
+        self.assertEqual(list(response), [b"first", b"second"])
+        reporter.report.assert_not_called()
+        response.close()
+        response.close()
+        reporter.report.assert_called_once()
+        path, stats = reporter.report.call_args[0]
+        self.assertEqual(path, "/export")
+        self.assertEqual(stats["select"], 2)
+
     def test__call__for_unavailable_path(self):
         mw = EasyProfileMiddleware(
             mock.Mock(),
@@ -114,7 +296,7 @@ class TestEasyProfileMiddleware(unittest.TestCase):
             self.assertEqual(mocked_report_stats.call_args[0][0], expected)
 
     def test__call__with_multiple_concurrent_calls(self):
-        fake_response = "fake response"
+        fake_response = (b"fake response",)
 
         def fake_call(*args, **kwargs):
             sleep(1)
@@ -149,3 +331,75 @@ class TestEasyProfileMiddleware(unittest.TestCase):
 
         assert len(results) == repeats
         assert set(results) == {fake_response}
+
+
+class TestEasyProfileASGIMiddleware(unittest.IsolatedAsyncioTestCase):
+
+    def test_initialization_default(self):
+        mw = EasyProfileASGIMiddleware(mock.Mock())
+        self.assertTrue(mw.context_local)
+        self.assertIsInstance(mw.reporter, StreamReporter)
+
+    async def test__call__for_available_path(self):
+        app = mock.AsyncMock()
+        mw = EasyProfileASGIMiddleware(app, reporter=mock.Mock(spec=Reporter))
+        scope = dict(type="http", path="/api/roles", method="GET")
+        with mock.patch.object(mw, "_report_stats") as mocked_report_stats:
+            await mw(scope, None, None)
+            app.assert_awaited_with(scope, None, None)
+            mocked_report_stats.assert_called()
+            self.assertEqual(
+                mocked_report_stats.call_args[0][0], "GET /api/roles"
+            )
+
+    async def test__call__for_unavailable_path(self):
+        app = mock.AsyncMock()
+        mw = EasyProfileASGIMiddleware(
+            app,
+            reporter=mock.Mock(spec=Reporter),
+            exclude_path=[r"^/api/users"]
+        )
+        with mock.patch.object(mw, "_report_stats") as mocked_report_stats:
+            await mw(dict(type="http", path="/api/users"), None, None)
+            await mw(dict(type="lifespan"), None, None)
+            self.assertEqual(app.await_count, 2)
+            mocked_report_stats.assert_not_called()
+
+    async def test__call__with_force_header(self):
+        app = mock.AsyncMock()
+        mw = EasyProfileASGIMiddleware(
+            app,
+            reporter=mock.Mock(spec=Reporter),
+            sample_rate=0,
+            force_header="X-Profile",
+        )
+        scope = dict(type="http", path="/about", headers=[])
+        with mock.patch.object(mw, "_report_stats") as mocked_report_stats:
+            await mw(scope, None, None)
+            mocked_report_stats.assert_not_called()
+            scope["headers"] = [(b"x-profile", b"1")]
+            await mw(scope, None, None)
+            mocked_report_stats.assert_called_once()
+
+    async def test__call__with_multiple_concurrent_calls(self):
+        engine = create_async_engine("sqlite+aiosqlite://")
+
+        async def app(scope, receive, send):
+            async with engine.connect() as conn:
+                for _ in range(scope["count"]):
+                    await conn.execute(text("SELECT 1"))
+                    await asyncio.sleep(0)
+
+        reporter = mock.Mock(spec=Reporter)
+        mw = EasyProfileASGIMiddleware(app, engine, reporter=reporter)
+        await asyncio.gather(*(
+            mw(dict(type="http", path="/{0}".format(n), count=n), None, None)
+            for n in (1, 2, 3)
+        ))
+        await engine.dispose()
+
+        totals = {
+            call[0][0]: call[0][1]["total"]
+            for call in reporter.report.call_args_list
+        }
+        self.assertEqual(totals, {"/1": 1, "/2": 2, "/3": 3})
@@ -1,14 +1,42 @@
+import asyncio
 from collections import Counter
-from queue import Queue
+import json
+import os
+import sys
+import tempfile
+import threading
 import time
 import unittest
 from unittest import mock
 
-from sqlalchemy import create_engine, event
+import sqlalchemy
+from sqlalchemy import (
+    Column,
+    create_engine,
+    event,
+    Integer,
+    MetaData,
+    select,
+    Table,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import declarative_base, Session
 from sqlalchemy.sql import text
 
-from easy_profile.profiler import DebugQuery, SessionProfiler, SQL_OPERATORS
+from easy_profile import profiler as profiler_module
+from easy_profile.explain import default_explainer, Explainer
+from easy_profile.profiler import (
+    _FetchCursor,
+    _get_dispatcher,
+    DebugQuery,
+    FetchStats,
+    SessionProfiler,
+    SQL_KINDS,
+    SQL_OPERATORS,
+    Stats,
+)
 from easy_profile.reporters import Reporter
 
 
@@ -39,6 +67,60 @@ debug_queries = [
 ]
 
 
+class TestDebugQuery(unittest.TestCase):
+
+    def test_duration(self):
+        query = DebugQuery("SELECT 1", {}, 1000, 1500001000)
+        self.assertEqual(query.duration_ns, 1500000000)
+        self.assertEqual(query.duration, 1.5)
+
+    def test_slots(self):
+        query = DebugQuery("SELECT 1", {}, 0, 1)
+        self.assertFalse(hasattr(query, "__dict__"))
+
+
+class TestStats(unittest.TestCase):
+
+    def test_lazy(self):
+        factory = mock.Mock(return_value=42)
+        stats = Stats(total=1)
+        stats.lazy("answer", factory)
+        stats.freeze()
+        self.assertIn("answer", stats)
+        self.assertNotIn("question", stats)
+        factory.assert_not_called()
+        self.assertEqual(stats["answer"], 42)
+        self.assertEqual(stats.get("answer"), 42)
+        factory.assert_called_once_with()
+        self.assertEqual(stats, {"total": 1, "answer": 42})
+        self.assertIsNone(stats.get("question"))
+        with self.assertRaises(KeyError):
+            stats["question"]
+
+    def test_lazy_mapping(self):
+        stats = Stats(total=1)
+        stats.lazy("answer", lambda: 42)
+        self.assertEqual(list(stats), ["total", "answer"])
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(list(stats.items()), [("total", 1), ("answer", 42)])
+        self.assertEqual(dict(stats), {"total": 1, "answer": 42})
+        self.assertEqual(json.dumps(stats), '{"total": 1, "answer": 42}')
+        self.assertNotEqual(stats, {"total": 1})
+        self.assertEqual(stats.pop("answer"), 42)
+        self.assertEqual(list(stats), ["total"])
+
+    def test_lazy_frozen(self):
+        values = iter(range(3))
+        stats = Stats()
+        stats.lazy("answer", lambda: next(values))
+        # Values change until the statistics are frozen
+        self.assertEqual(stats["answer"], 0)
+        self.assertEqual(stats["answer"], 1)
+        stats.freeze()
+        self.assertEqual(stats["answer"], 2)
+        self.assertEqual(stats["answer"], 2)
+
+
 class TestSessionProfiler(unittest.TestCase):
 
     def test_initialization_default(self):
@@ -46,13 +128,19 @@ class TestSessionProfiler(unittest.TestCase):
         self.assertIs(profiler.engine, Engine)
         self.assertEqual(profiler.db_name, "default")
         self.assertFalse(profiler.alive)
+        self.assertFalse(profiler.persistent)
         self.assertIsNone(profiler.queries)
 
     def test_initialization_custom(self):
         engine = create_engine("sqlite:///test")
-        profiler = SessionProfiler(engine)
+        profiler = SessionProfiler(engine, persistent=True)
         self.assertIs(profiler.engine, engine)
         self.assertEqual(profiler.db_name, "test")
+        self.assertTrue(profiler.persistent)
+
+    def test_initialization_sampling_error(self):
+        with self.assertRaises(ValueError):
+            SessionProfiler(sampling="random")
 
     def test_begin(self):
         profiler = SessionProfiler()
@@ -60,8 +148,7 @@ class TestSessionProfiler(unittest.TestCase):
             profiler.begin()
             mocked.assert_called()
             self.assertTrue(profiler.alive)
-            self.assertIsInstance(profiler.queries, Queue)
-            self.assertTrue(profiler.queries.empty())
+            self.assertEqual(profiler.queries, [])
             self.assertTrue(event.contains(
                 profiler.engine,
                 profiler._before,
@@ -72,6 +159,27 @@ class TestSessionProfiler(unittest.TestCase):
                 profiler._after,
                 profiler._after_cursor_execute
             ))
+        # Remove listeners of the global session
+        profiler._reset_stats()
+        profiler.commit()
+
+    def test_begin_persistent(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, persistent=True)
+        dispatcher = _get_dispatcher(engine)
+        profiler.begin()
+        self.assertTrue(profiler.alive)
+        self.assertIn(profiler, dispatcher.sessions)
+        self.assertTrue(event.contains(
+            engine, profiler._before, dispatcher._before_cursor_execute
+        ))
+        self.assertTrue(event.contains(
+            engine, profiler._after, dispatcher._after_cursor_execute
+        ))
+        self.assertFalse(event.contains(
+            engine, profiler._after, profiler._after_cursor_execute
+        ))
+        profiler.commit()
 
     def test_begin_alive(self):
         profiler = SessionProfiler()
@@ -100,6 +208,114 @@ class TestSessionProfiler(unittest.TestCase):
                 profiler._after_cursor_execute
             ))
 
+    def test_commit_persistent(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, persistent=True)
+        dispatcher = _get_dispatcher(engine)
+        profiler.begin()
+        profiler.commit()
+        self.assertFalse(profiler.alive)
+        self.assertNotIn(profiler, dispatcher.sessions)
+        # Listeners stay installed for the next profiling session
+        self.assertTrue(event.contains(
+            engine, profiler._after, dispatcher._after_cursor_execute
+        ))
+
+    def test_persistent_sessions(self):
+        engine = self._create_engine()
+        first = SessionProfiler(engine, persistent=True)
+        second = SessionProfiler(engine, persistent=True)
+        with first:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                with second:
+                    conn.execute(text("SELECT 2"))
+        self.assertEqual(first.stats["select"], 2)
+        self.assertEqual(second.stats["select"], 1)
+        self.assertIs(_get_dispatcher(engine), _get_dispatcher(engine))
+
+    def test_context_local_sessions(self):
+        engine = self._create_engine()
+        barrier = threading.Barrier(3)
+        profilers = {}
+
+        def target(count):
+            profiler = SessionProfiler(engine, context_local=True)
+            with profiler:
+                # All sessions are alive while queries are executed
+                barrier.wait()
+                with engine.connect() as conn:
+                    for _ in range(count):
+                        conn.execute(text("SELECT 1"))
+                barrier.wait()
+            profilers[count] = profiler
+
+        threads = [threading.Thread(target=target, args=(n,)) for n in (1, 2)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        barrier.wait()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(profilers[1].persistent)
+        self.assertEqual(profilers[1].stats["total"], 1)
+        self.assertEqual(profilers[2].stats["total"], 2)
+        self.assertEqual(_get_dispatcher(engine)._local.get(), ())
+
+    def test_concurrent_queries(self):
+        profiler = SessionProfiler(callsites=True)
+        count = 200
+
+        def target():
+            for _ in range(count):
+                profiler._after_cursor_execute(
+                    conn=None,
+                    cursor=None,
+                    statement="SELECT id FROM users",
+                    parameters={},
+                    context=mock.Mock(_query_start_time=0,
+                                      _query_before_ns=0,
+                                      _query_after_ns=0),
+                    executemany=False,
+                )
+
+        threads = [threading.Thread(target=target) for _ in range(8)]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with profiler:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        stats = profiler.stats
+        self.assertEqual(stats["total"], 8 * count)
+        self.assertEqual(stats["select"], 8 * count)
+        self.assertEqual(len(stats["call_stack"]), 8 * count)
+        self.assertEqual(
+            stats["statements"]["select id from users"].count, 8 * count
+        )
+        callsite, = stats["callsites"].values()
+        self.assertEqual(callsite.count, 8 * count)
+
+    def test_query_after_commit(self):
+        profiler = SessionProfiler()
+        context = mock.Mock(_query_start_time=0, _query_before_ns=0,
+                            _query_after_ns=0)
+        with profiler:
+            pass
+        # Listeners may still be running for a query of another thread
+        profiler._after_cursor_execute(None, None, "SELECT 1", {}, context,
+                                       False)
+        self.assertEqual(profiler.stats["total"], 0)
+        self.assertEqual(profiler.stats["call_stack"], [])
+
     def test_commit_alive(self):
         profiler = SessionProfiler()
         profiler.alive = False
@@ -117,17 +333,19 @@ class TestSessionProfiler(unittest.TestCase):
         self.assertEqual(profiler._stats["select"], 0)
         self.assertEqual(profiler._stats["insert"], 0)
         self.assertEqual(profiler._stats["update"], 0)
+        for kind in SQL_KINDS:
+            self.assertEqual(profiler._stats[kind], 0)
         self.assertEqual(profiler._stats["call_stack"], [])
         self.assertEqual(profiler._stats["duplicates"], Counter())
         self.assertEqual(profiler._stats["db"], profiler.db_name)
 
     def test__get_stats(self):
         profiler = SessionProfiler()
-        profiler.queries = Queue()
+        profiler.queries = []
         profiler._reset_stats()
         duplicates = Counter()
         for query in debug_queries:
-            profiler.queries.put(query)
+            profiler._add_query(query)
             duplicates_count = duplicates.get(query.statement, -1)
             duplicates[query.statement] = duplicates_count + 1
 
@@ -139,15 +357,43 @@ class TestSessionProfiler(unittest.TestCase):
 
         self.assertEqual(stats["db"], profiler.db_name)
         self.assertEqual(stats["total"], len(debug_queries))
+        self.assertEqual(stats["duration_ns"], len(debug_queries))
+        self.assertEqual(stats["duration"], len(debug_queries) / 1e9)
         self.assertListEqual(debug_queries, stats["call_stack"])
         self.assertDictEqual(stats["duplicates"], duplicates)
+        self.assertEqual(profiler.queries, [])
+
+        statement = "INSERT INTO users (name) VALUES (%(param_1)s)"
+        entry = stats["statements"]["insert into users (name) values (?+)"]
+        # The second insert has new parameters
+        self.assertEqual(entry, (statement, 2, 2, 0, 0, 1, 1))
+
+    def test_timer(self):
+        self.assertIs(profiler_module._timer, time.perf_counter_ns)
+
+    def test__get_stats_duplicates_fingerprint(self):
+        profiler = SessionProfiler()
+        profiler.queries = []
+        profiler._reset_stats()
+        for query in [
+            DebugQuery("SELECT id FROM users WHERE id IN (?)", (1,), 0, 1),
+            DebugQuery("SELECT id FROM users WHERE id IN (?, ?)", (), 1, 2),
+            DebugQuery("SELECT id FROM users WHERE id = 1", (), 2, 3),
+            DebugQuery("SELECT id FROM users WHERE id = 2", (), 3, 4),
+        ]:
+            profiler._add_query(query)
+        stats = profiler._get_stats()
+        self.assertDictEqual(stats["duplicates"], {
+            "SELECT id FROM users WHERE id IN (?)": 1,
+            "SELECT id FROM users WHERE id = 1": 1,
+        })
 
     @mock.patch("easy_profile.profiler._timer")
     def test__before_cursor_execute(self, mocked):
-        expected_time = time.time()
+        expected_time = time.perf_counter_ns()
         mocked.return_value = expected_time
         profiler = SessionProfiler()
-        context = mock.Mock()
+        context = mock.Mock(execution_options={})
         profiler._before_cursor_execute(
             conn=None,
             cursor=None,
@@ -163,7 +409,7 @@ class TestSessionProfiler(unittest.TestCase):
         expected_query = debug_queries[0]
         mocked.return_value = expected_query.end_time
         profiler = SessionProfiler()
-        context = mock.Mock()
+        context = mock.Mock(_query_before_ns=0, _query_after_ns=0)
         context._query_start_time = expected_query.start_time
         with profiler:
             profiler._after_cursor_execute(
@@ -174,9 +420,524 @@ class TestSessionProfiler(unittest.TestCase):
                 context=context,
                 executemany=None
             )
-            actual_query = profiler.queries.get()
+            actual_query = profiler.queries[0]
             self.assertEqual(actual_query, expected_query)
 
+    def test__get_stats_kinds(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine)
+        with profiler:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE TABLE users (id int)"))
+                with conn.begin_nested():
+                    conn.execute(text(
+                        "WITH t AS (SELECT 1 AS id) "
+                        "INSERT INTO users SELECT id FROM t"
+                    ))
+                conn.execute(text("-- users\nSELECT id FROM users"))
+                conn.execute(text("PRAGMA foreign_keys"))
+
+        stats = profiler.stats
+        self.assertEqual(stats["ddl"], 1)
+        self.assertEqual(stats["cte"], 1)
+        self.assertEqual(stats["select"], 1)
+        self.assertEqual(stats["transaction"], 2)
+        self.assertEqual(stats["other"], 1)
+        self.assertEqual(stats["total"], 6)
+        self.assertEqual(
+            stats["duration_ns"],
+            sum(query.duration_ns for query in stats["call_stack"]),
+        )
+        # Transaction control statements aren't duplicates
+        self.assertEqual(len(stats["duplicates"]), 4)
+
+    def test__get_stats_lazy_duplicates(self):
+        profiler = SessionProfiler()
+        with mock.patch("easy_profile.profiler._get_duplicates") as mocked:
+            profiler.begin()
+            profiler._add_query(debug_queries[0])
+            profiler.commit()
+            self.assertEqual(profiler.stats["total"], 1)
+            mocked.assert_not_called()
+            profiler.stats["duplicates"]
+            mocked.assert_called_once()
+
+    def test__get_stats_dict(self):
+        profiler = SessionProfiler()
+        profiler.begin()
+        profiler._add_query(debug_queries[0])
+        # Statistics read before commit aren't frozen
+        self.assertEqual(profiler.stats["duplicates"], Counter())
+        profiler._add_query(debug_queries[1])
+        profiler.commit()
+        stats = dict(profiler.stats)
+        for key in ("duplicates", "statements", "repeats", "fanouts",
+                    "callsites", "tables", "models"):
+            self.assertIn(key, stats)
+        self.assertEqual(stats["duplicates"], {"SELECT id FROM users": 1})
+
+    def test_max_queries_ring(self):
+        profiler = SessionProfiler(max_queries=3)
+        profiler.begin()
+        for query in debug_queries:
+            profiler._add_query(query)
+        profiler.commit()
+        stats = profiler.stats
+        self.assertListEqual(stats["call_stack"], debug_queries[-3:])
+        # Aggregated statistics aren't affected by the limit
+        self.assertEqual(stats["total"], len(debug_queries))
+        self.assertEqual(stats["select"], 4)
+        self.assertEqual(stats["duration_ns"], len(debug_queries))
+        self.assertEqual(sum(stats["duplicates"].values()), 2)
+
+    def test_max_queries_reservoir(self):
+        profiler = SessionProfiler(max_queries=3, sampling="reservoir")
+        profiler.begin()
+        queries = [
+            DebugQuery("SELECT {0}".format(n), (), n, n + 1)
+            for n in range(100)
+        ]
+        for query in queries:
+            profiler._add_query(query)
+        profiler.commit()
+        call_stack = profiler.stats["call_stack"]
+        self.assertEqual(len(call_stack), 3)
+        self.assertTrue(set(call_stack) < set(queries))
+        self.assertListEqual(
+            call_stack, sorted(call_stack, key=lambda q: q.start_time)
+        )
+        self.assertEqual(profiler.stats["total"], 100)
+
+    def test_max_parameters(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, max_parameters=2)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE users (id int)"))
+            with profiler:
+                conn.execute(
+                    text("INSERT INTO users (id) VALUES (:id)"),
+                    [{"id": n} for n in range(10)],
+                )
+                conn.execute(text("SELECT id FROM users WHERE id = :id"),
+                             {"id": 1})
+        inserted, selected = profiler.stats["call_stack"]
+        self.assertEqual(len(inserted.parameters), 2)
+        self.assertEqual(selected.parameters, (1,))
+
+        profiler = SessionProfiler(engine, max_parameters=0)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT :id"), {"id": 1})
+        self.assertIsNone(profiler.stats["call_stack"][0].parameters)
+
+    def test_slow_query_time(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, slow_query_time=0)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        slow_query, = profiler.stats["slow_queries"]
+        self.assertEqual(slow_query.query, profiler.stats["call_stack"][0])
+        self.assertIsNone(slow_query.plan)
+
+        profiler = SessionProfiler(engine, slow_query_time=60)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        self.assertEqual(profiler.stats["slow_queries"], [])
+
+    def test_explain(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # In-memory databases share a single connection
+        engine = create_engine(
+            "sqlite:///" + os.path.join(directory.name, "test.db")
+        )
+        self.addCleanup(engine.dispose)
+        explainer = Explainer(min_interval=0)
+        profiler = SessionProfiler(engine, slow_query_time=0,
+                                   explain=explainer)
+        observer = SessionProfiler(engine, persistent=True)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE users (id int)"))
+        with observer:
+            for _ in range(2):
+                with profiler:
+                    with engine.begin() as conn:
+                        conn.execute(
+                            text("SELECT id FROM users WHERE id = :id"),
+                            {"id": 1},
+                        )
+                        conn.execute(text("DELETE FROM users"))
+                # Plans of new statements are captured in the background
+                explainer.join()
+        select, delete = profiler.stats["slow_queries"][-2:]
+        self.assertIn("SCAN users", select.plan)
+        self.assertIsNone(delete.plan)
+        # Explained statements aren't captured by other sessions
+        self.assertEqual(observer.stats["total"], 2 * profiler.stats["total"])
+
+    def test_explain_not_explainable(self):
+        with self.assertRaises(ValueError):
+            SessionProfiler(self._create_engine(), explain=True)
+        with self.assertRaises(ValueError):
+            SessionProfiler(create_async_engine("sqlite+aiosqlite:///test"),
+                            explain=True)
+
+    def test_explain_shared_connection(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(slow_query_time=0, explain=True)
+        with engine.connect() as conn:
+            # Legacy connections of SQLAlchemy 1.4 don't autobegin
+            conn.begin()
+            conn.execute(text("CREATE TABLE users (id int)"))
+            with profiler:
+                conn.execute(text("INSERT INTO users VALUES (1)"))
+                conn.execute(text("SELECT id FROM users"))
+            default_explainer.join()
+            self.assertIsNone(profiler.stats["slow_queries"][-1].plan)
+            # The transaction of the application isn't rolled back
+            self.assertTrue(conn.in_transaction())
+            count = conn.execute(text("SELECT count(*) FROM users"))
+            self.assertEqual(count.scalar(), 1)
+
+    def test_callsites(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, callsites=True)
+        with profiler:
+            with engine.connect() as conn:
+                for _ in range(3):
+                    conn.execute(text("SELECT 1"))  # first call site
+                conn.execute(text("SELECT 2"))  # second call site
+        first, second = profiler.stats["callsites"]
+        self.assertEqual(first.filename, __file__)
+        self.assertEqual(first.function, "test_callsites")
+        self.assertEqual(second.lineno, first.lineno + 1)
+        self.assertEqual(profiler.stats["callsites"][first].count, 3)
+        self.assertEqual(profiler.stats["callsites"][second].count, 1)
+        callsites = [q.callsite for q in profiler.stats["call_stack"]]
+        self.assertEqual(callsites, [first] * 3 + [second])
+
+        profiler = SessionProfiler(engine)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        self.assertIsNone(profiler.stats["call_stack"][0].callsite)
+        self.assertEqual(profiler.stats["callsites"], {})
+
+    def test_callsites_skip_decorator(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, callsites=True)
+
+        @profiler(reporter=mock.Mock(spec=Reporter))
+        def func():
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+
+        func()
+        callsite, = profiler.stats["callsites"]
+        self.assertEqual(callsite.function, "func")
+
+    def test_fetches(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, fetches=True)
+        observer = SessionProfiler(engine, persistent=True, fetches=True)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE users (id int)"))
+            conn.execute(text("INSERT INTO users (id) VALUES (:id)"),
+                         [{"id": n} for n in range(10)])
+            with observer, profiler:
+                conn.execute(text("UPDATE users SET id = id WHERE id < 3"))
+                result = conn.execute(text("SELECT id FROM users"))
+                self.assertEqual(len(result.fetchmany(4)), 4)
+                self.assertEqual(len(result.all()), 6)
+        update, select = profiler.stats["call_stack"]
+        self.assertEqual(update.rowcount, 3)
+        self.assertIsNone(update.fetch)
+        self.assertEqual(select.fetch.rows, 10)
+        self.assertGreater(select.fetch.duration_ns, 0)
+        self.assertEqual(profiler.stats["rows_affected"], 3)
+        self.assertEqual(profiler.stats["rows_fetched"], 10)
+        self.assertEqual(profiler.stats["fetch_duration_ns"],
+                         select.fetch.duration_ns)
+        self.assertEqual(profiler.stats["fetch_duration"],
+                         select.fetch.duration)
+        # The cursor is wrapped only once for all sessions
+        self.assertIs(observer.stats["call_stack"][1].fetch, select.fetch)
+
+        profiler = SessionProfiler(engine)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT id FROM users")).all()
+        query = profiler.stats["call_stack"][0]
+        self.assertIsNone(query.rowcount)
+        self.assertIsNone(query.fetch)
+        self.assertEqual(profiler.stats["rows_fetched"], 0)
+
+    def test_fetch_cursor(self):
+        cursor = mock.Mock()
+        cursor.fetchone.side_effect = [(1,), (2,), None]
+        fetch = FetchStats()
+        proxy = _FetchCursor(cursor, fetch)
+        self.assertEqual(list(proxy), [(1,), (2,)])
+        self.assertEqual(fetch.rows, 2)
+        proxy.arraysize = 10
+        self.assertEqual(cursor.arraysize, 10)
+        self.assertIs(proxy.description, cursor.description)
+        self.assertEqual(repr(fetch), "FetchStats(rows=2, duration_ns={0})"
+                         .format(fetch.duration_ns))
+
+    def test_table_stats(self):
+        engine = self._create_engine()
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = "users"
+            id = Column(Integer, primary_key=True)
+
+        Base.metadata.create_all(engine)
+        profiler = SessionProfiler(engine, table_stats=True, fetches=True)
+        with profiler:
+            with Session(engine) as session:
+                session.add_all([User(id=n) for n in range(3)])
+                session.flush()
+                self.assertEqual(len(session.query(User).all()), 3)
+                session.execute(
+                    text("UPDATE users SET id = id + 10 WHERE id > 0")
+                )
+                session.execute(text("SELECT 1")).all()
+        tables = profiler.stats["tables"]
+        self.assertEqual(list(tables), ["users"])
+        self.assertEqual(tables["users"].count, 3)
+        # Rows inserted, fetched by the query and updated by the statement
+        self.assertEqual(tables["users"].rows, 8)
+        self.assertEqual(
+            tables["users"].duration_ns,
+            sum(q.duration_ns for q in profiler.stats["call_stack"][:3]),
+        )
+        models = profiler.stats["models"]
+        self.assertEqual(list(models), ["User"])
+        self.assertEqual(models["User"].count, 1)
+        self.assertEqual(models["User"].rows, 3)
+
+        profiler = SessionProfiler(engine)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT id FROM users"))
+        self.assertEqual(profiler.stats["tables"], {})
+        self.assertEqual(profiler.stats["models"], {})
+
+    def test_table_stats_compiled(self):
+        engine = self._create_engine()
+        metadata = MetaData()
+        users = Table("users", metadata, Column("id", Integer,
+                                                primary_key=True))
+        roles = Table("roles", metadata, Column("id", Integer))
+        metadata.create_all(engine)
+        profiler = SessionProfiler(engine, table_stats=True)
+        with profiler:
+            with engine.connect() as conn:
+                # Tables are taken from compiled statements
+                conn.execute(
+                    select(users.c.id).where(users.c.id == roles.c.id)
+                )
+                conn.execute(
+                    sqlite_insert(users).values(id=1).on_conflict_do_update(
+                        index_elements=["id"], set_={"id": 2},
+                    )
+                )
+                # Driver level statements fall back to the text
+                conn.exec_driver_sql("SELECT roles.id FROM roles, users")
+        tables = profiler.stats["tables"]
+        self.assertEqual(sorted(tables), ["roles", "users"])
+        self.assertEqual(tables["users"].count, 3)
+        self.assertEqual(tables["roles"].count, 2)
+
+    def test_repeats_and_fanouts(self):
+        engine = self._create_engine()
+        profiler = SessionProfiler(engine, max_parameters=0)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE users (id int)"))
+            with profiler:
+                for user_id in [1, 1, 2, 3, 1]:
+                    conn.execute(
+                        text("SELECT id FROM users WHERE id = :id"),
+                        {"id": user_id},
+                    )
+                for _ in range(2):
+                    conn.execute(
+                        text("INSERT INTO users (id) VALUES (:id)"),
+                        [{"id": 1}, {"id": 2}],
+                    )
+        select, insert = profiler.stats["statements"].values()
+        self.assertEqual((select.repeats, select.fanouts), (2, 2))
+        self.assertGreater(select.repeats_duration_ns, 0)
+        self.assertGreater(select.fanouts_duration_ns, 0)
+        self.assertEqual(
+            select.repeats_duration_ns + select.fanouts_duration_ns,
+            select.duration_ns - profiler.stats["call_stack"][0].duration_ns,
+        )
+        # Executemany queries are considered as unique
+        self.assertEqual((insert.repeats, insert.fanouts), (0, 1))
+        self.assertEqual(profiler.stats["repeats"], Counter({
+            select.statement: 2, insert.statement: 0,
+        }))
+        self.assertEqual(profiler.stats["fanouts"], Counter({
+            select.statement: 2, insert.statement: 1,
+        }))
+
+    def test__get_parameters_key(self):
+        _get_parameters_key = profiler_module._get_parameters_key
+        self.assertEqual(
+            _get_parameters_key("SELECT ?", (1,)),
+            _get_parameters_key("SELECT ?", (1,)),
+        )
+        self.assertNotEqual(
+            _get_parameters_key("SELECT ?", (1,)),
+            _get_parameters_key("SELECT ?", (2,)),
+        )
+        self.assertEqual(len(_get_parameters_key("SELECT ?", ("x" * 100,))),
+                         16)
+        # Digests are compared, not only hashes of the parameters
+        self.assertEqual(hash((-1,)), hash((-2,)))
+        self.assertNotEqual(
+            _get_parameters_key("SELECT ?", (-1,)),
+            _get_parameters_key("SELECT ?", (-2,)),
+        )
+        self.assertEqual(
+            _get_parameters_key("SELECT :a", {"a": [1, 2]}),
+            _get_parameters_key("SELECT :a", {"a": [1, 2]}),
+        )
+        self.assertIsNone(_get_parameters_key("SELECT ?", [(1,)], True))
+
+    def test_fanouts_hash_collision(self):
+        profiler = SessionProfiler()
+        profiler.begin()
+        statement = "SELECT id FROM users WHERE id = ?"
+        for parameters in [(-1,), (-2,)]:
+            profiler._add_query(DebugQuery(statement, parameters, 0, 1))
+        profiler.commit()
+        self.assertEqual(profiler.stats["repeats"][statement], 0)
+        self.assertEqual(profiler.stats["fanouts"][statement], 1)
+
+    def test_overhead(self):
+        engine = self._create_engine()
+        before = SessionProfiler.overhead_info()
+        profiler = SessionProfiler(engine)
+        with profiler:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                conn.execute(text("SELECT 2"))
+        overhead = profiler.stats["overhead"]
+        self.assertGreater(overhead["listener_ns"], 0)
+        self.assertGreater(overhead["stats_ns"], 0)
+        self.assertEqual(overhead["report_ns"], 0)
+
+        after = SessionProfiler.overhead_info()
+        self.assertGreaterEqual(after.sessions - before.sessions, 1)
+        self.assertGreaterEqual(after.queries - before.queries, 2)
+        self.assertGreaterEqual(after.listener_ns - before.listener_ns,
+                                overhead["listener_ns"])
+
+        reporter = mock.Mock(spec=Reporter)
+        profiler._report(reporter, "test")
+        reporter.report.assert_called_once_with("test", profiler.stats)
+        self.assertGreater(overhead["report_ns"], 0)
+        self.assertGreaterEqual(
+            SessionProfiler.overhead_info().report_ns - after.report_ns,
+            overhead["report_ns"],
+        )
+
+    def test_subtract_overhead(self):
+        engine = self._create_engine()
+        first = SessionProfiler(engine, persistent=True, max_parameters=10)
+        second = SessionProfiler(engine, persistent=True,
+                                 subtract_overhead=True)
+
+        def slow_listener(parameters, executemany):
+            time.sleep(0.01)
+            return parameters
+
+        with first, second:
+            # The first session spends 10ms before the second one
+            with mock.patch.object(first, "_limit_parameters",
+                                   slow_listener):
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+        query, = second.stats["call_stack"]
+        self.assertLess(query.duration, 0.01)
+        self.assertGreaterEqual(
+            first.stats["overhead"]["listener_ns"], 10000000
+        )
+
+    @unittest.skipIf(sqlalchemy.__version__ < "2",
+                     "insertmanyvalues requires SQLAlchemy 2.0")
+    def test_subtract_overhead_batches(self):
+        engine = create_engine("sqlite://", insertmanyvalues_page_size=2)
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = "users"
+            id = Column(Integer, primary_key=True)
+
+        Base.metadata.create_all(engine)
+        profiler = SessionProfiler(engine, subtract_overhead=True)
+        with profiler:
+            with Session(engine) as session:
+                session.add_all([User() for _ in range(10)])
+                session.flush()
+        # Batches share the execution context, the overhead of previous
+        # batches isn't subtracted again
+        inserts = [q for q in profiler.stats["call_stack"]
+                   if q.statement.startswith("INSERT")]
+        self.assertEqual(len(inserts), 10)
+        for query in inserts:
+            self.assertGreater(query.duration_ns, 0)
+
+    def test_before_overhead_counted_once(self):
+        first, second = SessionProfiler(), SessionProfiler()
+        context = mock.Mock(_query_start_time=0, _query_before_ns=10 ** 9,
+                            _query_after_ns=0)
+        with first, second:
+            for profiler in (first, second):
+                profiler._after_cursor_execute(
+                    conn=None, cursor=None, statement="SELECT 1",
+                    parameters=(), context=context, executemany=False,
+                )
+        self.assertGreaterEqual(first.stats["overhead"]["listener_ns"],
+                                10 ** 9)
+        self.assertLess(second.stats["overhead"]["listener_ns"], 10 ** 9)
+
+    def test_cache_info(self):
+        profiler = SessionProfiler()
+        profiler.queries = []
+        profiler._reset_stats()
+        before = profiler.cache_info()
+        for query in debug_queries:
+            profiler._add_query(query)
+        after = profiler.cache_info()
+        lookups = after.hits + after.misses - before.hits - before.misses
+        self.assertEqual(lookups, len(debug_queries))
+
+    def test__after_cursor_execute_interned_statement(self):
+        profiler = SessionProfiler()
+        profiler.begin()
+        statement = "".join(["SELECT ", "name FROM users"])
+        for _ in range(2):
+            profiler._after_cursor_execute(
+                conn=None,
+                cursor=None,
+                statement="".join(["SELECT name ", "FROM users"]),
+                parameters={},
+                context=mock.Mock(_query_start_time=0, _query_before_ns=0,
+                                  _query_after_ns=0),
+                executemany=False,
+            )
+        profiler.commit()
+        first, second = profiler.stats["call_stack"]
+        self.assertEqual(first.statement, statement)
+        self.assertIs(first.statement, second.statement)
+
     def test_stats(self):
         profiler = SessionProfiler()
         self.assertIsNotNone(profiler.stats)
@@ -196,9 +957,10 @@ class TestSessionProfiler(unittest.TestCase):
         wrapper(self._decorated_func)(engine)
         # Test profile statistics
         self.assertEqual(profiler.stats["db"], "undefined")
-        self.assertEqual(profiler.stats["total"], 4)
+        self.assertEqual(profiler.stats["total"], 5)
         self.assertEqual(profiler.stats["select"], 3)
         self.assertEqual(profiler.stats["delete"], 1)
+        self.assertEqual(profiler.stats["ddl"], 1)
         self.assertEqual(profiler.stats["duplicates_count"], 1)
 
     def test_decorator_path(self):
@@ -258,3 +1020,66 @@ class TestSessionProfiler(unittest.TestCase):
             conn.execute(text("SELECT id FROM users"))
             conn.execute(text("SELECT name FROM users"))
             conn.execute(text("DELETE FROM users"))
+
+
+class TestAsyncSessionProfiler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine("sqlite+aiosqlite://")
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    def test_initialization(self):
+        profiler = SessionProfiler(self.engine)
+        self.assertIs(profiler.engine, self.engine.sync_engine)
+        self.assertEqual(profiler.db_name, "undefined")
+
+    async def test_async_contextmanager_interface(self):
+        profiler = SessionProfiler(self.engine)
+        async with profiler:
+            self.assertTrue(profiler.alive)
+            async with self.engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+                await conn.execute(text("SELECT 2"))
+        self.assertFalse(profiler.alive)
+        self.assertEqual(profiler.stats["select"], 2)
+
+    async def test_async_decorator(self):
+        profiler = SessionProfiler(self.engine)
+        reporter = mock.Mock(spec=Reporter)
+
+        async def decorated():
+            async with self.engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return "result"
+
+        wrapper = profiler(path="test_path", reporter=reporter)(decorated)
+        self.assertEqual(await wrapper(), "result")
+        reporter.report.assert_called_with("test_path", profiler.stats)
+        self.assertEqual(profiler.stats["total"], 1)
+
+    async def test_callsites(self):
+        profiler = SessionProfiler(self.engine, callsites=True)
+        async with profiler:
+            async with self.engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))  # call site
+        callsite, = profiler.stats["callsites"]
+        self.assertEqual(callsite.filename, __file__)
+        self.assertEqual(callsite.function, "test_callsites")
+        self.assertEqual(
+            profiler.stats["call_stack"][0].callsite, callsite
+        )
+
+    async def test_context_local_tasks(self):
+        async def task(count):
+            profiler = SessionProfiler(self.engine, context_local=True)
+            async with profiler:
+                async with self.engine.connect() as conn:
+                    for _ in range(count):
+                        await conn.execute(text("SELECT 1"))
+                        await asyncio.sleep(0)
+            return profiler.stats["total"]
+
+        results = await asyncio.gather(*(task(n) for n in (1, 2, 3)))
+        self.assertEqual(results, [1, 2, 3])
@@ -1,19 +1,34 @@
 from collections import Counter
+import threading
 import unittest
 from unittest import mock
 
 import sqlparse
 
-from easy_profile.reporters import shorten, StreamReporter
+from easy_profile.profiler import (
+    Callsite,
+    CallsiteStats,
+    DebugQuery,
+    SlowQuery,
+    StatementStats,
+    TableStats,
+)
+from easy_profile.reporters import (
+    format_duration,
+    QueuedReporter,
+    Reporter,
+    shorten,
+    StreamReporter,
+)
 
 
 expected_table = """
-|----------|--------|--------|--------|--------|--------|------------|
-| Database | SELECT | INSERT | UPDATE | DELETE | Totals | Duplicates |
-|----------|--------|--------|--------|--------|--------|------------|
-| default  |   8    |   2    |   3    |   0    |   13   |     3      |
-|----------|--------|--------|--------|--------|--------|------------|
-"""
+|----------|--------|--------|--------|--------|-----|-----|-----|-------|--------|------------|
+| Database | SELECT | INSERT | UPDATE | DELETE | CTE | DDL | TCL | Other | Totals | Duplicates |
+|----------|--------|--------|--------|--------|-----|-----|-----|-------|--------|------------|
+| default  |   8    |   2    |   3    |   0    |  1  |  0  |  2  |   1   |   17   |     3      |
+|----------|--------|--------|--------|--------|-----|-----|-----|-------|--------|------------|
+"""  # noqa: E501
 
 expected_table_stats = {
     "db": "default",
@@ -21,7 +36,11 @@ expected_table_stats = {
     "insert": 2,
     "update": 3,
     "delete": 0,
-    "total": 13,
+    "cte": 1,
+    "ddl": 0,
+    "transaction": 2,
+    "other": 1,
+    "total": 17,
     "duration": 0.0345683,
     "duplicates": Counter({
         "SELECT id FROM users": 2,
@@ -47,6 +66,15 @@ class TestShorten(unittest.TestCase):
         self.assertEqual(shorten("test test", 7, placeholder="!!!"), expected)
 
 
+class TestFormatDuration(unittest.TestCase):
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(0), "0µs")
+        self.assertEqual(format_duration(0.000512), "512µs")
+        self.assertEqual(format_duration(0.0345683), "34.6ms")
+        self.assertEqual(format_duration(1.5), "1.50s")
+
+
 class TestStreamReporter(unittest.TestCase):
 
     def test_initialization(self):
@@ -63,6 +91,8 @@ class TestStreamReporter(unittest.TestCase):
         self.assertEqual(reporter._file, mocked_file)
         self.assertFalse(reporter._colorized)
         self.assertEqual(reporter._display_duplicates, 0)
+        self.assertIsNone(reporter._max_format_length)
+        self.assertEqual(reporter._format_statement.cache_info().maxsize, 256)
 
     def test_initialization_default(self):
         reporter = StreamReporter()
@@ -105,6 +135,120 @@ class TestStreamReporter(unittest.TestCase):
             reporter._info_line("test", reporter._medium - 1)
             mocked.assert_called_with("test", ["bold"], fg="green")
 
+    def test_report_format_cache(self):
+        reporter = StreamReporter(file=mock.Mock(), format_cache_size=0)
+        with mock.patch("easy_profile.reporters.sqlparse") as mocked:
+            mocked.format.return_value = "SELECT"
+            reporter.report("test", dict(expected_table_stats))
+            reporter.report("test", dict(expected_table_stats))
+            self.assertEqual(mocked.format.call_count, 4)
+
+        reporter = StreamReporter(file=mock.Mock(), format_cache_size=10)
+        with mock.patch("easy_profile.reporters.sqlparse") as mocked:
+            mocked.format.return_value = "SELECT"
+            reporter.report("test", dict(expected_table_stats))
+            reporter.report("test", dict(expected_table_stats))
+            self.assertEqual(mocked.format.call_count, 2)
+
+    def test_report_max_format_length(self):
+        dest = mock.Mock()
+        reporter = StreamReporter(
+            colorized=False, file=dest, max_format_length=20
+        )
+        with mock.patch("easy_profile.reporters.sqlparse") as mocked:
+            mocked.format.side_effect = lambda statement, **kw: statement
+            reporter.report("test", dict(expected_table_stats))
+            mocked.format.assert_called_once_with(
+                "SELECT id FROM users", reindent=True, keyword_case="upper"
+            )
+        output = dest.write.call_args[0][0]
+        self.assertIn("SELECT id, name FROM users", output)
+
+    def test_report_repeats(self):
+        dest = mock.Mock()
+        reporter = StreamReporter(colorized=False, file=dest)
+        stats = dict(expected_table_stats, statements={
+            "select id from users": StatementStats(
+                "SELECT id FROM users", 3, 3000000, 2, 2000000, 0, 0
+            ),
+        })
+        reporter.report("test", stats)
+        output = dest.write.call_args[0][0]
+        self.assertIn(
+            "\nRepeated 3 times:\nSELECT id\nFROM users\n"
+            "2 with equal parameters in 2.0ms, "
+            "0 with other parameters (N+1) in 0µs\n",
+            output,
+        )
+
+    def test_report_slow_queries(self):
+        dest = mock.Mock()
+        reporter = StreamReporter(
+            colorized=False, file=dest, display_slow_queries=1
+        )
+        stats = dict(expected_table_stats, slow_queries=[
+            SlowQuery(DebugQuery("SELECT 1", (), 0, 2000000), None),
+            SlowQuery(DebugQuery("SELECT 2", (), 0, 3000000), "SCAN users"),
+        ])
+        reporter.report("test", stats)
+        output = dest.write.call_args[0][0]
+        self.assertIn("\nSlow query in 3.0ms:\nSELECT 2\nPlan:\nSCAN users\n",
+                      output)
+        self.assertNotIn("SELECT 1", output)
+
+    def test_report_rows_fetched(self):
+        dest = mock.Mock()
+        reporter = StreamReporter(colorized=False, file=dest)
+        stats = dict(
+            expected_table_stats, rows_fetched=120, fetch_duration=0.0032
+        )
+        reporter.report("test", stats)
+        output = dest.write.call_args[0][0]
+        self.assertIn(
+            "Total queries: 17 in 34.6ms, 120 rows fetched in 3.2ms", output
+        )
+
+    def test_report_callsites(self):
+        dest = mock.Mock()
+        reporter = StreamReporter(
+            colorized=False, file=dest, display_callsites=1
+        )
+        stats = dict(expected_table_stats, callsites={
+            Callsite("app/views.py", 42, "list_users"):
+                CallsiteStats(120, 24000000),
+            Callsite("app/views.py", 7, "index"): CallsiteStats(1, 1000),
+        })
+        reporter.report("test", stats)
+        output = dest.write.call_args[0][0]
+        self.assertIn(
+            "\nCall sites:\n"
+            "120 queries in 24.0ms at app/views.py:42 in list_users\n",
+            output,
+        )
+        self.assertNotIn("index", output)
+
+    def test_report_tables(self):
+        dest = mock.Mock()
+        reporter = StreamReporter(
+            colorized=False, file=dest, display_tables=1
+        )
+        stats = dict(
+            expected_table_stats,
+            tables={
+                "order_items": TableStats(70, 7000000, 1400),
+                "orders": TableStats(10, 1000000, 10),
+            },
+            models={"OrderItem": TableStats(60, 6000000, 1200)},
+        )
+        reporter.report("test", stats)
+        output = dest.write.call_args[0][0]
+        self.assertIn(
+            "\nTables:\norder_items: 70 queries in 7.0ms, 1400 rows\n"
+            "\nModels:\nOrderItem: 60 queries in 6.0ms, 1200 rows\n",
+            output,
+        )
+        self.assertNotIn("orders:", output)
+
     def test_stats_table(self):
         reporter = StreamReporter(colorized=False)
         actual_table = reporter.stats_table(expected_table_stats)
@@ -126,8 +270,7 @@ class TestStreamReporter(unittest.TestCase):
         expected_output += expected_table
 
         total = expected_table_stats["total"]
-        duration = expected_table_stats["duration"]
-        summary = "\nTotal queries: {0} in {1:.3}s\n".format(total, duration)
+        summary = "\nTotal queries: {0} in 34.6ms\n".format(total)
         expected_output += summary
 
         actual_output = dest.write.call_args[0][0]
@@ -139,3 +282,72 @@ class TestStreamReporter(unittest.TestCase):
             )
             text = "\nRepeated {0} times:\n{1}\n".format(count + 1, statement)
             self.assertRegexpMatches(actual_output, text)
+
+
+class TestQueuedReporter(unittest.TestCase):
+
+    def test_initialization_error(self):
+        with self.assertRaises(TypeError):
+            QueuedReporter(mock.Mock())
+
+    def test_report(self):
+        reporter = mock.Mock(spec=Reporter)
+        queued = QueuedReporter(reporter)
+        queued.report("path", {"total": 1})
+        queued.flush()
+        reporter.report.assert_called_once_with("path", {"total": 1})
+        queued.close()
+        self.assertIsNone(queued._worker)
+
+    def test_report_in_worker_thread(self):
+        threads = []
+        reporter = mock.Mock(spec=Reporter)
+        reporter.report.side_effect = (
+            lambda path, stats: threads.append(threading.current_thread())
+        )
+        queued = QueuedReporter(reporter)
+        queued.report("path", {})
+        queued.close()
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_report_drop(self):
+        event = threading.Event()
+        reporter = mock.Mock(spec=Reporter)
+        reporter.report.side_effect = lambda path, stats: event.wait()
+        queued = QueuedReporter(reporter, maxsize=1)
+        queued.report("first", {})
+        # Wait until the worker takes the first report
+        while not queued._queue.empty():
+            pass
+        queued.report("second", {})
+        queued.report("third", {})
+        self.assertEqual(queued.dropped, 1)
+        event.set()
+        queued.close()
+        self.assertEqual(reporter.report.call_count, 2)
+
+    def test_report_block_timeout(self):
+        event = threading.Event()
+        reporter = mock.Mock(spec=Reporter)
+        reporter.report.side_effect = lambda path, stats: event.wait()
+        queued = QueuedReporter(reporter, maxsize=1, block=True, timeout=0.01)
+        queued.report("first", {})
+        while not queued._queue.empty():
+            pass
+        queued.report("second", {})
+        queued.report("third", {})
+        self.assertEqual(queued.dropped, 1)
+        event.set()
+        queued.close()
+
+    def test_report_error(self):
+        reporter = mock.Mock(spec=Reporter)
+        reporter.report.side_effect = [Exception("boom"), None]
+        queued = QueuedReporter(reporter)
+        with self.assertLogs("easy_profile.reporters", level="ERROR"):
+            queued.report("first", {})
+            queued.flush()
+        queued.report("second", {})
+        queued.close()
+        self.assertEqual(reporter.report.call_count, 2)
@@ -0,0 +1,173 @@
+import unittest
+
+from easy_profile.statements import (
+    cache_info,
+    classify,
+    fingerprint,
+    get_tables,
+    StatementInfo,
+)
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_literals(self):
+        expected = "select id from users where name = ? and age > ?"
+        statements = [
+            "SELECT id FROM users WHERE name = 'Arthur' AND age > 42",
+            "SELECT id FROM users WHERE name = 'Ford''s' AND age > 4.2",
+            "SELECT id FROM users WHERE name = ? AND age > ?",
+            "SELECT id FROM users WHERE name = %s AND age > %s",
+            "SELECT id FROM users WHERE name = :name AND age > :age",
+            "SELECT id FROM users WHERE name = $1 AND age > $2",
+            "SELECT id FROM users WHERE name = %(name)s AND age > %(age)s",
+        ]
+        for statement in statements:
+            self.assertEqual(fingerprint(statement), expected)
+
+    def test_lists(self):
+        expected = "select id from users where id in (?+)"
+        statements = [
+            "SELECT id FROM users WHERE id IN (?)",
+            "SELECT id FROM users WHERE id IN (?, ?, ?)",
+            "SELECT id FROM users WHERE id IN (%(id_1_1)s, %(id_1_2)s)",
+            "SELECT id FROM users WHERE id IN (1, 2, 3, 4)",
+        ]
+        for statement in statements:
+            self.assertEqual(fingerprint(statement), expected)
+
+        self.assertEqual(
+            fingerprint("INSERT INTO users (id) VALUES (?), (?), (?)"),
+            fingerprint("INSERT INTO users (id) VALUES (?)"),
+        )
+
+    def test_whitespace_case_and_comments(self):
+        self.assertEqual(
+            fingerprint("/* users */ SELECT id\n  FROM users -- all\n"),
+            "select id from users",
+        )
+
+    def test_quotes_in_comments(self):
+        statement = (
+            "-- don't cache\nSELECT name FROM users WHERE name = 'bob'"
+        )
+        self.assertEqual(
+            fingerprint(statement), "select name from users where name = ?"
+        )
+        info = classify(statement)
+        self.assertEqual(info.kind, "select")
+        self.assertEqual(info.tables, ("users",))
+        self.assertEqual(
+            fingerprint("SELECT '-- no /* comment' FROM users /* it's */"),
+            "select ? from users",
+        )
+
+    def test_identifiers(self):
+        statement = "SELECT users_1.id, t2.name FROM users AS users_1, t2"
+        self.assertEqual(fingerprint(statement), statement.lower())
+        self.assertEqual(
+            fingerprint("SELECT CAST(x AS INT), y::int FROM t"),
+            "select cast(x as int), y::int from t",
+        )
+
+
+class TestGetTables(unittest.TestCase):
+
+    def test_get_tables(self):
+        cases = [
+            ("select id from users", ("users",)),
+            ("select u.id from users as u join roles r on r.id = u.id",
+             ("users", "roles")),
+            ('insert into "public"."users" (id) values (?+)',
+             ("public.users",)),
+            ("update `users` set name=?", ("users",)),
+            ("delete from users where id in (select id from users)",
+             ("users",)),
+            ("select ?", ()),
+        ]
+        for normalized, expected in cases:
+            self.assertEqual(get_tables(normalized), expected)
+
+    def test_get_tables_keywords(self):
+        cases = [
+            ("select a from t for update nowait", ("t",)),
+            ("select a from t for update of t skip locked", ("t",)),
+            ("insert into t (a) values (?) on conflict (a) do update set a=?",
+             ("t",)),
+            ("create table if not exists t (id int)", ("t",)),
+            ("select * from generate_series(?, ?)", ()),
+        ]
+        for normalized, expected in cases:
+            self.assertEqual(get_tables(normalized), expected)
+
+    def test_get_tables_lists(self):
+        cases = [
+            ("select * from a, b", ("a", "b")),
+            ("select * from a x, b as y,c where x.id = y.id",
+             ("a", "b", "c")),
+            ("select * from a, generate_series(?, ?) s", ("a",)),
+        ]
+        for normalized, expected in cases:
+            self.assertEqual(get_tables(normalized), expected)
+
+
+class TestClassify(unittest.TestCase):
+
+    def setUp(self):
+        classify.cache_clear()
+
+    def test_classify(self):
+        statement = "SELECT id FROM users WHERE id = 42"
+        self.assertEqual(
+            classify(statement),
+            StatementInfo(
+                statement,
+                "select",
+                "select",
+                "select id from users where id = ?",
+                ("users",),
+            ),
+        )
+
+    def test_classify_kinds(self):
+        cases = [
+            ("DELETE FROM users", "delete", "delete"),
+            ("/* comment */ SELECT 1", "select", "select"),
+            ("(SELECT 1) UNION (SELECT 2)", "select", "select"),
+            ("INSERT INTO users (id) VALUES (?) RETURNING id",
+             "insert", "insert"),
+            ("WITH t AS (SELECT 1) SELECT * FROM t", "with", "cte"),
+            ("CREATE TABLE users (id int)", "create", "ddl"),
+            ("ALTER TABLE users ADD name varchar", "alter", "ddl"),
+            ("DROP INDEX ix_users_name", "drop", "ddl"),
+            ("BEGIN", "begin", "transaction"),
+            ("SAVEPOINT sa_savepoint_1", "savepoint", "transaction"),
+            ("RELEASE SAVEPOINT sa_savepoint_1", "release", "transaction"),
+            ("ROLLBACK TO SAVEPOINT sa_savepoint_1",
+             "rollback", "transaction"),
+            ("CALL refresh_stats()", "call", "other"),
+            ("COPY users FROM STDIN", "copy", "other"),
+            ("PRAGMA foreign_keys", "pragma", "other"),
+            ("", None, "other"),
+        ]
+        for statement, operator, kind in cases:
+            info = classify(statement)
+            self.assertEqual(info.operator, operator)
+            self.assertEqual(info.kind, kind)
+
+    def test_interned_statement(self):
+        statement = "".join(["SELECT ", "id FROM users"])
+        copy = "".join(["SELECT id ", "FROM users"])
+        self.assertIsNot(statement, copy)
+        self.assertIs(classify(statement).statement, statement)
+        self.assertIs(classify(copy).statement, statement)
+
+    def test_cache_info(self):
+        self.assertEqual(cache_info().hit_rate, 0.0)
+        statement = "SELECT id FROM users"
+        self.assertIs(classify(statement), classify(statement))
+        info = cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.currsize, 1)
+        self.assertEqual(info.hit_rate, 0.5)
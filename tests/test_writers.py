@@ -0,0 +1,183 @@
+from collections import Counter
+import gc
+import io
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import weakref
+
+from easy_profile import reporters
+from easy_profile.reporters import StreamReporter
+from easy_profile.writers import BufferedWriter
+
+
+class TestBufferedWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "profile.log")
+
+    def read(self, path=None):
+        with open(path or self.path, encoding="utf-8") as file:
+            return file.read()
+
+    def test_initialization_error(self):
+        with self.assertRaises(ValueError):
+            BufferedWriter()
+        with self.assertRaises(ValueError):
+            BufferedWriter(file=io.StringIO(), path=self.path)
+        with self.assertRaises(ValueError):
+            BufferedWriter(file=io.StringIO(), max_bytes=10)
+
+    def test_write_buffer_size(self):
+        dest = mock.Mock()
+        writer = BufferedWriter(file=dest, buffer_size=10,
+                                flush_interval=None)
+        self.assertEqual(writer.write("12345"), 5)
+        dest.write.assert_not_called()
+        writer.write("67890")
+        dest.write.assert_called_once_with("1234567890")
+        writer.write("x")
+        writer.flush()
+        dest.write.assert_called_with("x")
+        writer.flush()
+        self.assertEqual(dest.write.call_count, 2)
+
+    @mock.patch("easy_profile.writers.time.monotonic")
+    def test_write_flush_interval(self, mocked):
+        mocked.return_value = 0
+        dest = mock.Mock()
+        writer = BufferedWriter(file=dest, flush_interval=1)
+        writer.write("a")
+        dest.write.assert_not_called()
+        mocked.return_value = 1
+        writer.write("b")
+        dest.write.assert_called_once_with("ab")
+
+    def test_flush_by_timer(self):
+        dest = mock.Mock()
+        flushed = threading.Event()
+        dest.flush.side_effect = flushed.set
+        writer = BufferedWriter(file=dest, flush_interval=0.01)
+        writer.write("a")
+        # Buffered text is written without another write
+        self.assertTrue(flushed.wait(5))
+        dest.write.assert_called_once_with("a")
+        self.assertIsNone(writer._timer)
+        writer.close()
+
+    def test_flush_error(self):
+        dest = mock.Mock()
+        dest.write.side_effect = [OSError(), None]
+        writer = BufferedWriter(file=dest, flush_interval=None)
+        writer.write("a")
+        with self.assertRaises(OSError):
+            writer.flush()
+        writer.write("b")
+        writer.flush()
+        # Text isn't lost by a failed write
+        dest.write.assert_called_with("ab")
+
+    def test_flush_error_retained(self):
+        dest = mock.Mock()
+        dest.write.side_effect = OSError()
+        writer = BufferedWriter(file=dest, buffer_size=0,
+                                flush_interval=None, max_retained=4)
+        with self.assertLogs("easy_profile.writers") as logs:
+            for text in ("ab", "cd", "ef", "gh"):
+                # Failures aren't raised to the application
+                writer.write(text)
+        # The failure is logged once and isn't retried by every write
+        self.assertEqual(len(logs.records), 1)
+        dest.write.assert_called_once_with("ab")
+        # The oldest texts over the limit are dropped
+        self.assertEqual(writer._buffer, ["ef", "gh"])
+        self.assertEqual(writer.dropped, 2)
+        with self.assertRaises(OSError):
+            writer.flush()
+        self.assertEqual(writer._buffer, ["ef", "gh"])
+
+        dest.write.side_effect = None
+        writer.flush()
+        dest.write.assert_called_with("efgh")
+        writer.write("ij")
+        dest.write.assert_called_with("ij")
+
+    def test_flush_at_exit(self):
+        dest = mock.Mock()
+        writer = BufferedWriter(file=dest, flush_interval=None)
+        writer.write("a")
+        reporters._flush_all()
+        dest.write.assert_called_once_with("a")
+        # Writers aren't kept alive by the exit hook
+        ref = weakref.ref(writer)
+        del writer
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_close(self):
+        writer = BufferedWriter(path=self.path)
+        writer.write("report\n")
+        self.assertEqual(self.read(), "")
+        writer.close()
+        writer.close()
+        self.assertEqual(self.read(), "report\n")
+        with self.assertRaises(ValueError):
+            writer.write("report\n")
+
+    def test_rotate(self):
+        writer = BufferedWriter(path=self.path, buffer_size=0,
+                                max_bytes=10, backup_count=2)
+        for report in ["first\n", "second\n", "third\n", "fourth\n"]:
+            writer.write(report)
+            writer.write(report)
+        writer.close()
+        self.assertEqual(self.read(), "")
+        self.assertEqual(self.read(self.path + ".1"), "fourth\nfourth\n")
+        self.assertEqual(self.read(self.path + ".2"), "third\nthird\n")
+        self.assertFalse(os.path.exists(self.path + ".3"))
+
+    def test_rotate_without_backups(self):
+        writer = BufferedWriter(path=self.path, buffer_size=0,
+                                max_bytes=10, backup_count=0)
+        writer.write("0123456789")
+        writer.write("x")
+        writer.close()
+        self.assertEqual(self.read(), "x")
+        self.assertFalse(os.path.exists(self.path + ".1"))
+
+    def test_write_concurrent(self):
+        writer = BufferedWriter(path=self.path, buffer_size=100)
+        reporter = StreamReporter(colorized=False, file=writer)
+        stats = {
+            "db": "default", "select": 1, "insert": 0, "update": 0,
+            "delete": 0, "cte": 0, "ddl": 0, "transaction": 0, "other": 0,
+            "total": 1, "duration": 0.001, "duplicates": Counter(),
+        }
+
+        def report(index):
+            for _ in range(50):
+                reporter.report("path-{0}".format(index), dict(stats))
+
+        threads = [
+            threading.Thread(target=report, args=(n,)) for n in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        output = self.read()
+        expected = StreamReporter(colorized=False, file=mock.Mock())
+        self.assertEqual(output.count("Total queries: 1 in 1.0ms"), 200)
+        for index in range(4):
+            expected_report = io.StringIO()
+            expected._file = expected_report
+            expected.report("path-{0}".format(index), dict(stats))
+            self.assertEqual(
+                output.count(expected_report.getvalue()), 50
+            )